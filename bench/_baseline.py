@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+
+from libs.pycrypter.exceptions import DecryptFileError
+
+
+class BaselineCrypter:
+    """libs.pycrypter.Crypter as it was before the cached AESGCM context: a new Cipher and encryptor or
+    decryptor per call and an os.urandom nonce per message. Same output format, kept only to compare against."""
+
+    def __init__(self, key: str | bytes):
+        self.key = hashlib.sha256(key if isinstance(key, bytes) else key.encode()).digest()
+        self._backend = default_backend()
+
+    def encrypt(self, data: bytes) -> bytes:
+        iv = os.urandom(12)
+        cipher = Cipher(algorithms.AES(self.key), modes.GCM(iv), backend=self._backend)
+
+        encryptor = cipher.encryptor()
+        encrypted_data = encryptor.update(data) + encryptor.finalize()
+
+        return iv + encrypted_data + encryptor.tag
+
+    def decrypt(self, data: bytes) -> bytes:
+        if len(data) < 28:
+            raise DecryptFileError("Invalid encrypted data: too short")
+
+        iv = data[:12]
+        tag = data[-16:]
+        encrypted_data = data[12:-16]
+
+        cipher = Cipher(algorithms.AES(self.key), modes.GCM(iv, tag), backend=self._backend)
+        decryptor = cipher.decryptor()
+
+        return decryptor.update(encrypted_data) + decryptor.finalize()
@@ -0,0 +1,67 @@
+"""Per-packet crypto cost of a legacy request/response pair, before and after the cached AESGCM context.
+
+A packet pair decrypts the request's transaction code and payload and encrypts the response's, the four
+cipher operations ClientConnection does per request. Run from the repository root:
+
+    python -m bench.crypter_bench [--sizes 64,1024,16384,262144] [--packets 20000]
+"""
+import argparse
+import os
+import time
+
+from libs.pycrypter import SessionCrypter
+
+from ._baseline import BaselineCrypter
+
+
+TRANSACTION_CODE = b"READ_ALL_MESSAGES"
+
+
+def bench_baseline(key: bytes, payload: bytes, packets: int) -> float:
+    crypter = BaselineCrypter(key)
+    request = (crypter.encrypt(TRANSACTION_CODE), crypter.encrypt(payload))
+
+    started_at = time.perf_counter()
+    for _ in range(packets):
+        crypter.decrypt(request[0])
+        crypter.decrypt(request[1])
+        b"".join((crypter.encrypt(TRANSACTION_CODE), crypter.encrypt(payload)))
+
+    return (time.perf_counter() - started_at) / packets
+
+
+def bench_session(key: bytes, payload: bytes, packets: int) -> float:
+    crypter = SessionCrypter(key, direction=SessionCrypter.SERVER_TO_CLIENT)
+    request = (crypter.encrypt(TRANSACTION_CODE), crypter.encrypt(payload))
+
+    started_at = time.perf_counter()
+    for _ in range(packets):
+        crypter.decrypt(request[0])
+        crypter.decrypt(request[1])
+        response = bytearray()
+        crypter.encrypt_into(response, TRANSACTION_CODE)
+        crypter.encrypt_into(response, payload)
+
+    return (time.perf_counter() - started_at) / packets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="64,1024,16384,262144", help="Comma-separated payload sizes in bytes")
+    parser.add_argument("--packets", type=int, default=20000, help="Packet pairs per size (fewer for large sizes)")
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+
+    print(f"{'payload':>10} {'before us':>10} {'after us':>10} {'speedup':>8}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        payload = os.urandom(size)
+        packets = max(100, args.packets * 1024 // max(size, 1024))
+
+        before = bench_baseline(key, payload, packets)
+        after = bench_session(key, payload, packets)
+        print(f"{size:>10} {before * 1e6:>10.2f} {after * 1e6:>10.2f} {before / after:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
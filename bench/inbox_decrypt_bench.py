@@ -0,0 +1,72 @@
+"""Decrypting a whole inbox of at-rest encrypted messages, before and after the cached key and batch decrypt.
+
+Before: every read opens the key file and builds a Crypter, then decrypts message by message with a new
+cipher per message. After: the KeyManager's cached Crypter decrypts the batch with decrypt_many, inline and
+fanned out over a thread pool. Run from the repository root:
+
+    python -m bench.inbox_decrypt_bench [--messages 10000] [--size 256] [--workers 4] [--reads 5]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from serv.db_api.keys import KeyManager
+
+from ._baseline import BaselineCrypter
+
+
+KEY_NAME = "crypt_messages_key.bin"
+
+
+def bench_baseline(keys_path: str, inbox: list[bytes]) -> float:
+    started_at = time.perf_counter()
+
+    with open(file=f"{keys_path}/{KEY_NAME}", mode="rb") as key_file:
+        crypter = BaselineCrypter(key=key_file.read())
+    for payload in inbox:
+        crypter.decrypt(payload)
+
+    return time.perf_counter() - started_at
+
+
+def bench_batch(key_manager: KeyManager, inbox: list[bytes], executor: ThreadPoolExecutor | None) -> float:
+    started_at = time.perf_counter()
+    key_manager.crypter(KEY_NAME).decrypt_many(inbox, executor=executor, skip_invalid=True)
+    return time.perf_counter() - started_at
+
+
+def best_of(reads: int, func, *args) -> float:
+    return min(func(*args) for _ in range(reads))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000, help="Messages in the inbox")
+    parser.add_argument("--size", type=int, default=256, help="Plain payload size of a message in bytes")
+    parser.add_argument("--workers", type=int, default=4, help="Decrypt threads of the fanned out run")
+    parser.add_argument("--reads", type=int, default=5, help="Inbox reads per variant, the best one is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as keys_path:
+        key_manager = KeyManager(keys_path)
+        key_manager.make_keys([KEY_NAME])
+
+        crypter = key_manager.crypter(KEY_NAME)
+        inbox = crypter.encrypt_many([os.urandom(args.size) for _ in range(args.messages)])
+
+        before = best_of(args.reads, bench_baseline, keys_path, inbox)
+        inline = best_of(args.reads, bench_batch, key_manager, inbox, None)
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="crypt") as executor:
+            fanned_out = best_of(args.reads, bench_batch, key_manager, inbox, executor)
+
+    print(f"{args.messages} messages of {args.size} bytes")
+    for title, seconds in (("before", before), ("decrypt_many", inline),
+                           (f"decrypt_many, {args.workers} threads", fanned_out)):
+        print(f"{title:>26}: {seconds * 1e3:8.2f} ms  {before / seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,2 @@
-from .core import CryptedFile, Crypter
-from .utils import gen_key
+from .core import CryptedChunkedFile, CryptedFile, CryptedLog, Crypter, SessionCrypter
+from .utils import gen_key, hash_password, verify_password
@@ -1,17 +1,31 @@
 import hashlib
+import itertools
+import mmap
 import pickle
 import os
+import struct
+import threading
 
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, Sequence
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from .exceptions import DecryptFileError, EncryptFileError
 
 
 class Crypter:
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    OVERHEAD = NONCE_SIZE + TAG_SIZE
+
+    # Batches smaller than this are processed inline even when an executor is given
+    PARALLEL_THRESHOLD = 256
+
     def __init__(self, key: str | bytes):
         self.key = self.format_key(key)
-        self._backend = default_backend()
+        self._aesgcm = AESGCM(self.key)
 
     @staticmethod
     def format_key(key: str | bytes) -> bytes:
@@ -21,33 +35,84 @@ class Crypter:
             return hashlib.sha256(key.encode()).digest()
         raise ValueError("Key must be string or bytes")
 
-    def encrypt(self, data: bytes) -> bytes:
-        iv = os.urandom(12)
-        cipher = Cipher(algorithms.AES(self.key), modes.GCM(iv), backend=self._backend)
+    def _next_nonce(self) -> bytes:
+        return os.urandom(self.NONCE_SIZE)
 
-        encryptor = cipher.encryptor()
-        encrypted_data = encryptor.update(data) + encryptor.finalize()
+    def encrypt(self, data: bytes | bytearray | memoryview, associated_data: bytes | None = None) -> bytes:
+        iv = self._next_nonce()
+        return iv + self._aesgcm.encrypt(iv, data, associated_data)
 
-        return iv + encrypted_data + encryptor.tag
+    def encrypt_into(self, out: bytearray, data: bytes | bytearray | memoryview):
+        """Appends ``nonce | ciphertext | tag`` to ``out``, so a whole frame can be built in one buffer."""
+        iv = self._next_nonce()
+        out += iv
+        out += self._aesgcm.encrypt(iv, data, None)
 
-    def decrypt(self, data: bytes) -> bytes:
-        if len(data) < 28:
+    def decrypt(self, data: bytes | bytearray | memoryview, associated_data: bytes | None = None) -> bytes:
+        if len(data) < self.OVERHEAD:
             raise DecryptFileError("Invalid encrypted data: too short")
 
-        iv = data[:12]
-        tag = data[-16:]
-        encrypted_data = data[12:-16]
+        data = memoryview(data)
+        return self._aesgcm.decrypt(data[:self.NONCE_SIZE], data[self.NONCE_SIZE:], associated_data)
+
+    def _decrypt_or_none(self, data: bytes | bytearray | memoryview) -> bytes | None:
+        try:
+            return self.decrypt(data)
+        except (DecryptFileError, InvalidTag):
+            return None
+
+    def _map(self, func: Callable, items: Sequence, executor: Executor | None) -> list:
+        if executor is None or len(items) < self.PARALLEL_THRESHOLD:
+            return [func(item) for item in items]
+
+        # One task per chunk, not per item: per-task overhead would outweigh a small message's AES work
+        workers = getattr(executor, "_max_workers", None) or os.cpu_count() or 1
+        chunk_size = max(self.PARALLEL_THRESHOLD // 4, -(-len(items) // workers))
+        chunks = executor.map(lambda chunk: [func(item) for item in chunk],
+                              [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)])
+        return [result for chunk in chunks for result in chunk]
+
+    def encrypt_many(self, items: Sequence[bytes | bytearray | memoryview],
+                     executor: Executor | None = None) -> list[bytes]:
+        """encrypt() for a batch, in order; large batches are split across ``executor`` if given
+        (OpenSSL releases the GIL while it works)."""
+        return self._map(self.encrypt, items, executor)
+
+    def decrypt_many(self, items: Sequence[bytes | bytearray | memoryview], executor: Executor | None = None,
+                     skip_invalid: bool = False) -> list[bytes | None]:
+        """decrypt() for a batch, in order. With ``skip_invalid`` items that fail to decrypt come back as None
+        instead of failing the whole batch."""
+        return self._map(self._decrypt_or_none if skip_invalid else self.decrypt, items, executor)
+
+
+class SessionCrypter(Crypter):
+    """Crypter for one side of a session: nonces are a 4-byte direction prefix plus a 64-bit
+    message counter instead of os.urandom, so they never repeat for the lifetime of the key.
+    The output format is the same as Crypter's, so the peer can decrypt it with either class."""
+
+    SERVER_TO_CLIENT = 1
+    CLIENT_TO_SERVER = 2
 
-        cipher = Cipher(algorithms.AES(self.key), modes.GCM(iv, tag), backend=self._backend)
-        decryptor = cipher.decryptor()
-        
-        return decryptor.update(encrypted_data) + decryptor.finalize()
+    def __init__(self, key: str | bytes, direction: int):
+        super().__init__(key=key)
+        self._nonce_prefix = struct.pack("!I", direction)
+        self._counter = 0
+        self._counter_lock = threading.Lock()
+
+    def _next_nonce(self) -> bytes:
+        with self._counter_lock:
+            if self._counter >= 2 ** 64:
+                raise OverflowError("Session nonce space exhausted, the session key must be renegotiated")
+            counter = self._counter
+            self._counter += 1
+
+        return self._nonce_prefix + struct.pack("!Q", counter)
 
 
 class CryptedFile:
-    def __init__(self, filename: str, key: str | bytes):
+    def __init__(self, filename: str, key: str | bytes | Crypter):
         self.filename = str(filename)
-        self.crypter = Crypter(key=key)
+        self.crypter = key if isinstance(key, Crypter) else Crypter(key=key)
 
     def read(self):
         try:
@@ -57,7 +122,7 @@ class CryptedFile:
                     raise DecryptFileError("File is empty")
                 decrypted_data = self.crypter.decrypt(encrypted_data)
                 return pickle.loads(decrypted_data)
-        except (pickle.UnpicklingError, UnicodeDecodeError, EOFError) as e:
+        except (InvalidTag, pickle.UnpicklingError, UnicodeDecodeError, EOFError) as e:
             raise DecryptFileError from e
 
     def write(self, new_data: object):
@@ -66,8 +131,364 @@ class CryptedFile:
 
         try:
             serialized_data = pickle.dumps(new_data)
-            encrypted_data = self.crypter.encrypt(serialized_data)
-            with open(self.filename, "wb") as file:
-                file.write(encrypted_data)
         except (TypeError, pickle.PicklingError) as e:
             raise EncryptFileError from e
+
+        encrypted_data = self.crypter.encrypt(serialized_data)
+
+        # Written aside and renamed over the old file, so a crash mid-write leaves the previous version intact
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as file:
+            file.write(encrypted_data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self.filename)
+
+
+class CryptedLog:
+    """Encrypted snapshot plus an append-only log of the records written after it.
+
+    The snapshot is a CryptedChunkedFile of records at ``filename``; the log at ``filename + ".log"`` holds entries
+    of ``u32 length | Crypter.encrypt(pickle((seq, record)))``, so an append costs one record's encryption and write.
+    compact() replaces the snapshot with the caller's state records and empties the log. The snapshot's first
+    record is the seq of the last log record it covers: after a crash between the two steps the stale log entries
+    are skipped. Snapshots are written a segment and read a page of records at a time, never held in memory whole."""
+
+    LOG_SUFFIX = ".log"
+    ENTRY_HEADER = struct.Struct("!I")
+
+    def __init__(self, filename: str, key: str | bytes | Crypter, fsync: bool = False, compact_every: int = 4096):
+        self.snapshot = CryptedChunkedFile(filename=filename, key=key)
+        self.crypter = self.snapshot.crypter
+        self.log_filename = self.snapshot.filename + self.LOG_SUFFIX
+
+        self.fsync = fsync
+        self.compact_every = max(1, int(compact_every))
+
+        self._file = None
+        self._seq = 0
+        self._log_records = 0
+        self._lock = threading.Lock()
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self._log_records >= self.compact_every
+
+    def recover(self) -> tuple[Iterator[object], list]:
+        """Reads the log records appended after the snapshot, drops a torn or corrupt log tail and opens the log
+        for appending. Returns (snapshot records, log records in append order); the snapshot records are
+        decrypted lazily, a page at a time, and must be consumed before the next compact()."""
+        with self._lock:
+            state, snapshot_seq = iter(()), 0
+            if os.path.exists(self.snapshot.filename):
+                self.snapshot.open()
+                try:
+                    snapshot_seq = self.snapshot.read_record(0)
+                except BaseException:
+                    self.snapshot.close()
+                    raise
+                state = self._iter_snapshot()
+
+            records = []
+            seq, valid_size, log_records = snapshot_seq, 0, 0
+            if os.path.exists(self.log_filename):
+                with open(self.log_filename, "rb") as file:
+                    for (record_seq, record), end in self._read_entries(file):
+                        if record_seq > snapshot_seq:
+                            if record_seq != seq + 1:
+                                break
+                            records.append(record)
+                            seq = record_seq
+
+                        valid_size = end
+                        log_records += 1
+
+            self._file = open(self.log_filename, "ab")
+            if self._file.tell() != valid_size:
+                self._file.truncate(valid_size)
+                self._file.seek(valid_size)
+
+            self._seq = seq
+            self._log_records = log_records
+            return state, records
+
+    def _iter_snapshot(self) -> Iterator[object]:
+        try:
+            yield from self.snapshot.iter_records(start=1)
+        finally:
+            self.snapshot.close()
+
+    def _read_entries(self, file):
+        position = 0
+        while True:
+            header = file.read(self.ENTRY_HEADER.size)
+            if len(header) < self.ENTRY_HEADER.size:
+                return
+            length, = self.ENTRY_HEADER.unpack(header)
+            body = file.read(length)
+            if len(body) < length:
+                return
+
+            try:
+                entry = pickle.loads(self.crypter.decrypt(body))
+            except (DecryptFileError, InvalidTag, pickle.UnpicklingError, EOFError, ValueError):
+                return
+
+            position += self.ENTRY_HEADER.size + length
+            yield entry, position
+
+    def append(self, record: object) -> int:
+        """Encrypts and appends one record, returns its seq."""
+        with self._lock:
+            if self._file is None:
+                raise EncryptFileError("CryptedLog is not open, call recover() first")
+
+            try:
+                body = self.crypter.encrypt(pickle.dumps((self._seq + 1, record), protocol=pickle.HIGHEST_PROTOCOL))
+            except (TypeError, pickle.PicklingError) as e:
+                raise EncryptFileError from e
+
+            self._file.write(self.ENTRY_HEADER.pack(len(body)) + body)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+            self._seq += 1
+            self._log_records += 1
+            return self._seq
+
+    def compact(self, records: Iterable[object]):
+        """Snapshots the state ``records``, which must already include every appended record, and empties the log.
+
+        The records are pickled and encrypted as they are iterated, so the state is never serialized whole."""
+        with self._lock:
+            self.snapshot.write_records(itertools.chain((self._seq,), records))
+
+            if self._file is not None:
+                self._file.truncate(0)
+                self._file.seek(0)
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            self._log_records = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CryptedChunkedFile:
+    """Encrypted container split into fixed-size, independently authenticated segments, read through mmap.
+
+    Layout: ``header | segment 0 | segment 1 | ...``, where the header is ``b"SWCF" | u8 version | u8 flags |
+    u32 segment_size`` and each segment is ``nonce | ciphertext | tag`` of up to segment_size plaintext bytes.
+    A segment's associated data is the header, its index and a last-segment flag, so segments can't be
+    swapped, moved between files or cut off at a segment boundary. Segment i starts at a fixed offset, so
+    read_range() decrypts only the segments it overlaps and memory stays bounded by the range asked for.
+
+    Written by write_records(), the plaintext is the pickled records, an index of u64 record offsets and a
+    u64 index offset; read_record()/read_records() then fetch one record or a page of them by number."""
+
+    MAGIC = b"SWCF"
+    VERSION = 1
+    FLAG_RECORDS = 0x01
+
+    HEADER = struct.Struct("!4sBBI")
+    SEGMENT_AAD = struct.Struct("!Q?")
+    OFFSET = struct.Struct("!Q")
+
+    DEFAULT_SEGMENT_SIZE = 64 * 1024
+
+    def __init__(self, filename: str, key: str | bytes | Crypter, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        self.filename = str(filename)
+        self.crypter = key if isinstance(key, Crypter) else Crypter(key=key)
+        self.segment_size = int(segment_size)
+
+        self.flags = 0
+        self.size = 0
+        self.segment_count = 0
+        self.record_count = 0
+
+        self._file = None
+        self._mm = None
+        self._header = b""
+        self._index_offset = 0
+        self._cached_segment: tuple[int, bytes] | None = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write_segments(self, chunks: Iterable[bytes | bytearray | memoryview], flags: int):
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, flags, self.segment_size)
+        segment_index = 0
+        buffer = bytearray()
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as file:
+            file.write(header)
+
+            for chunk in chunks:
+                buffer += chunk
+                position = 0
+                # Keep one segment's worth buffered, so the last one is known when the input ends
+                with memoryview(buffer) as view:
+                    while len(buffer) - position > self.segment_size:
+                        file.write(self.crypter.encrypt(
+                            view[position:position + self.segment_size],
+                            header + self.SEGMENT_AAD.pack(segment_index, False)))
+                        position += self.segment_size
+                        segment_index += 1
+                del buffer[:position]
+
+            file.write(self.crypter.encrypt(bytes(buffer), header + self.SEGMENT_AAD.pack(segment_index, True)))
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.close()
+        os.replace(tmp_filename, self.filename)
+
+    def write(self, data: bytes | bytearray | memoryview | Iterable[bytes]):
+        """Replaces the file with ``data``, given whole or as an iterable of chunks."""
+        chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+        self._write_segments(chunks, flags=0)
+
+    def write_records(self, records: Iterable[object]):
+        """Replaces the file with pickled ``records``, addressable by number."""
+        offsets = [0]
+
+        def chunks():
+            for record in records:
+                try:
+                    serialized = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                except (TypeError, pickle.PicklingError) as e:
+                    raise EncryptFileError from e
+                offsets.append(offsets[-1] + len(serialized))
+                yield serialized
+
+            index_offset = offsets[-1]
+            yield b"".join(self.OFFSET.pack(offset) for offset in offsets)
+            yield self.OFFSET.pack(index_offset)
+
+        self._write_segments(chunks(), flags=self.FLAG_RECORDS)
+
+    def open(self):
+        if self._mm is not None:
+            return
+
+        self._file = open(self.filename, "rb")
+        try:
+            file_size = os.fstat(self._file.fileno()).st_size
+            if file_size < self.HEADER.size + Crypter.OVERHEAD:
+                raise DecryptFileError("File is too short")
+
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._header = self._mm[:self.HEADER.size]
+            magic, version, self.flags, self.segment_size = self.HEADER.unpack(self._header)
+            if magic != self.MAGIC or version != self.VERSION or self.segment_size <= 0:
+                raise DecryptFileError("Not a chunked crypted file")
+
+            stride = self.segment_size + Crypter.OVERHEAD
+            body_size = file_size - self.HEADER.size
+            self.segment_count = -(-body_size // stride)
+            last_size = body_size - (self.segment_count - 1) * stride - Crypter.OVERHEAD
+            if last_size < 0:
+                raise DecryptFileError("Truncated segment")
+            self.size = (self.segment_count - 1) * self.segment_size + last_size
+
+            self.record_count = 0
+            if self.flags & self.FLAG_RECORDS:
+                index_end = self.size - self.OFFSET.size
+                self._index_offset, = self.OFFSET.unpack(self.read_range(index_end, self.OFFSET.size))
+                self.record_count = (index_end - self._index_offset) // self.OFFSET.size - 1
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self._cached_segment = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read_segment(self, index: int) -> bytes:
+        if not 0 <= index < self.segment_count:
+            raise IndexError(f"Segment {index} out of range")
+        if self._cached_segment is not None and self._cached_segment[0] == index:
+            return self._cached_segment[1]
+
+        stride = self.segment_size + Crypter.OVERHEAD
+        start = self.HEADER.size + index * stride
+        is_last = index == self.segment_count - 1
+
+        try:
+            segment = self.crypter.decrypt(self._mm[start:start + stride],
+                                           self._header + self.SEGMENT_AAD.pack(index, is_last))
+        except InvalidTag as e:
+            raise DecryptFileError from e
+
+        self._cached_segment = (index, segment)
+        return segment
+
+    def iter_segments(self) -> Iterator[bytes]:
+        for index in range(self.segment_count):
+            yield self.read_segment(index)
+
+    def iter_records(self, start: int = 0, page_size: int = 1024) -> Iterator[object]:
+        """Records from ``start`` to the end in order, read ``page_size`` at a time, so only the segments
+        of one page are decrypted and held at once."""
+        for page_start in range(max(0, start), self.record_count, page_size):
+            yield from self.read_records(page_start, page_size)
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        """``length`` plaintext bytes from ``offset``, decrypting only the segments they span."""
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise IndexError(f"Range {offset}+{length} out of {self.size} bytes")
+
+        out = bytearray()
+        end = offset + length
+        while offset < end:
+            index, segment_offset = divmod(offset, self.segment_size)
+            segment = self.read_segment(index)
+            part = segment[segment_offset:segment_offset + end - offset]
+            out += part
+            offset += len(part)
+
+        return bytes(out)
+
+    def read(self) -> bytes:
+        return self.read_range(0, self.size)
+
+    def _record_offsets(self, start: int, count: int) -> list[int]:
+        raw = self.read_range(self._index_offset + start * self.OFFSET.size, (count + 1) * self.OFFSET.size)
+        return [self.OFFSET.unpack_from(raw, i * self.OFFSET.size)[0] for i in range(count + 1)]
+
+    def read_records(self, start: int = 0, count: int | None = None) -> list:
+        """Records ``start`` to ``start + count`` (to the end when count is None)."""
+        if not self.flags & self.FLAG_RECORDS:
+            raise DecryptFileError("File holds no records")
+
+        start = max(0, start)
+        count = self.record_count - start if count is None else min(count, self.record_count - start)
+        if count <= 0:
+            return []
+
+        offsets = self._record_offsets(start, count)
+        raw = memoryview(self.read_range(offsets[0], offsets[-1] - offsets[0]))
+
+        try:
+            return [pickle.loads(raw[offsets[i] - offsets[0]:offsets[i + 1] - offsets[0]]) for i in range(count)]
+        except (pickle.UnpicklingError, EOFError) as e:
+            raise DecryptFileError from e
+
+    def read_record(self, number: int) -> object:
+        if not 0 <= number < self.record_count:
+            raise IndexError(f"Record {number} out of range")
+        return self.read_records(number, 1)[0]
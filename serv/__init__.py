@@ -1,7 +1,11 @@
 from .config_parser import gen_config_util
+from .dh_optimizer import gen_dh_params_util
 
 
 def run_repl(args):
     if args.gen_conf_file:
         gen_config_util(args=args)
 
+    if args.gen_dh_params:
+        gen_dh_params_util(args=args)
+
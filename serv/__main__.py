@@ -16,6 +16,12 @@ def starter():
         action="store_true",
         help="If set, the server won't start — it will just generate a basic config file.")
 
+    arg_parser.add_argument(
+        "-d", "--gen_dh_params",
+        action="store_true",
+        help="If set, the server won't start — it will just generate the DH parameters file " + \
+             "(key size and path are taken from the [dh] config section).")
+
     args = arg_parser.parse_args()
     run_repl(args=args)
 
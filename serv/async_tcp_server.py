@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import socket
+
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from functools import partial
+from typing import Set, Callable
+
+from .client_protocol import DH_PUBLIC_LENGTH, ClientProtocol
+from .dh_optimizer import get_dh_exchange, build_conf_of_dh
+from .handshake import HELLO_SIZE, X25519Handshake, build_conf_of_handshake, load_tcp_protocol_version
+
+
+# Larger package bodies are decrypted in the request pool instead of on the event loop thread
+INLINE_DECRYPT_MAX_SIZE = 65536
+
+
+class AsyncClientConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server_instance):
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername")
+        self.server_instance = server_instance
+        self.request_handle_func = self.server_instance.request_handle_func
+
+        self.running = True
+        self.protocol = ClientProtocol(self.server_instance, self.client_address)
+
+        self._in_flight = asyncio.Semaphore(self.server_instance.max_in_flight)
+        self._requests: Set[asyncio.Task] = set()
+
+    async def _recv_exact(self, num_bytes: int) -> bytes:
+        try:
+            return await self.reader.readexactly(num_bytes)
+        except asyncio.IncompleteReadError:
+            return b""
+
+    async def _recv_client_hello(self) -> bytes | None:
+        """Waits for an X25519 client hello, None means the client expects the legacy DH handshake."""
+        if not self.protocol.expects_hello:
+            return None
+
+        if self.protocol.hello_timeout is not None:
+            # Legacy clients stay silent until they get the DH parameters, new ones speak first. Only the first
+            # byte has to arrive in time, a hello that comes in pieces is still read in full
+            try:
+                first_byte = await asyncio.wait_for(self._recv_exact(1), timeout=self.protocol.hello_timeout)
+            except asyncio.TimeoutError:
+                return None
+
+            if not first_byte:
+                raise ConnectionResetError("Client closed connection before handshake")
+
+            hello = first_byte + await self._recv_exact(HELLO_SIZE - 1)
+        else:
+            hello = await self._recv_exact(HELLO_SIZE)
+
+        if len(hello) != HELLO_SIZE:
+            raise ConnectionResetError("Client closed connection while sending hello")
+
+        return hello
+
+    async def __init_session__(self):
+        try:
+            hello = await self._recv_client_hello()
+            if hello is None:
+                await self.__init_dh_session__()
+            else:
+                self.writer.write(self.protocol.finish_x25519_handshake(hello))
+                await self.writer.drain()
+
+            self.protocol.start_session()
+
+        except ConnectionResetError:
+            self.stop()
+        except Exception:
+            logging.exception(
+                f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
+                f"Key exchange failed for client {self.client_address[0]}:")
+            raise
+
+    async def __init_dh_session__(self):
+        # Finite-field DH is milliseconds of CPU per step (and key generation when the pool runs dry),
+        # so it runs in the request pool to keep the other connections' I/O going
+        loop = asyncio.get_running_loop()
+        executor = self.server_instance.request_executor
+
+        server_private_key, server_handshake = await loop.run_in_executor(executor, self.protocol.create_dh_handshake)
+
+        self.writer.write(server_handshake)
+        await self.writer.drain()
+
+        client_public_length_bytes = await self._recv_exact(DH_PUBLIC_LENGTH.size)
+        if not client_public_length_bytes:
+            raise ConnectionResetError("Client closed connection while sending public key length")
+        client_public_length, = DH_PUBLIC_LENGTH.unpack(client_public_length_bytes)
+        client_public_bytes = await self._recv_exact(client_public_length)
+        if not client_public_bytes or len(client_public_bytes) != client_public_length:
+            raise ConnectionResetError("Client closed connection while sending public key bytes")
+
+        await loop.run_in_executor(executor, self.protocol.finish_dh_handshake, server_private_key, client_public_bytes)
+
+    async def _recv_package(self) -> tuple[bytes, str] | None:
+        header = await self._recv_exact(self.protocol.header_size)
+        if not header:
+            return None
+
+        lengths = self.protocol.decode_header(header)
+        if lengths is None:
+            return None
+        body_length, trans_length = lengths
+
+        body = await self._recv_exact(body_length)
+        if not body:
+            return None
+
+        if body_length > INLINE_DECRYPT_MAX_SIZE:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.server_instance.request_executor, self.protocol.decode_body, body, trans_length)
+
+        return self.protocol.decode_body(body, trans_length)
+
+    async def handle(self):
+        try:
+            await self.__init_session__()
+
+            while self.running:
+                try:
+                    received = await self._recv_package()
+                    if received is None:
+                        break
+                    data, transaction_code = received
+
+                    logging.info(
+                        f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
+                        f"Client {self.client_address[0]} sent package of code '{transaction_code}'")
+                    await self.process_request(data, transaction_code)
+
+                except (ConnectionResetError, asyncio.CancelledError):
+                    break
+
+                except Exception:
+                    if self.running:
+                        logging.exception(f"Error handling client {self.client_address[0]}")
+                    break
+
+        except Exception:
+            logging.exception(f"Error in client handler for {self.client_address[0]}")
+        finally:
+            if self._requests:
+                await asyncio.wait(self._requests, timeout=5.0)
+            await self.close_connection()
+
+    async def process_request(self, data: bytes, transaction_code: str):
+        """Starts the request as a task and returns at once, so the next package can be read while
+        this one is processed. Waits while the connection is at its in-flight limit."""
+        await self._in_flight.acquire()
+
+        task = asyncio.create_task(self._run_request(data, transaction_code))
+        self._requests.add(task)
+        task.add_done_callback(self._requests.discard)
+
+    async def _run_request(self, data: bytes, transaction_code: str):
+        try:
+            # Handlers are blocking (DB work), so they run in the server's pool to keep the loop free
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self.server_instance.request_executor,
+                partial(self.request_handle_func, pkg=data, transaction_code=transaction_code,
+                        session=self.protocol.session))
+
+            if isinstance(result, tuple):
+                await self.send_pkg(pkg=result[0], transaction_code=result[1])
+                return
+
+            # Streamed response: each page is fetched in the pool, then sent before the next one is read
+            frames = iter(result)
+            while (frame := await loop.run_in_executor(self.server_instance.request_executor, next, frames, None)):
+                await self.send_pkg(pkg=frame[0], transaction_code=frame[1])
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+        except Exception:
+            logging.exception(f"Error processing request of client {self.client_address[0]}")
+
+        finally:
+            self._in_flight.release()
+
+    async def send_pkg(self, pkg: bytes, transaction_code: str):
+        self.writer.write(self.protocol.encode_package(pkg, transaction_code))
+        await self.writer.drain()
+
+    async def close_connection(self):
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+            logging.info(
+                f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
+                f"Client {self.client_address[0]} disconnected")
+
+        except (ConnectionError, OSError):
+            pass
+
+        except Exception:
+            logging.exception(
+                f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
+                f"Error closing connection for client {self.client_address[0]}:")
+
+    def stop(self):
+        self.running = False
+        self.writer.close()
+
+
+class AsyncTCPServer:
+    def __init__(self, conf: ConfigParser, request_handle_func: Callable, title_: str | None = None):
+        self.conf = conf
+        self.request_handle_func = request_handle_func
+
+        self.title_ = title_
+
+        self.handling = False
+        self.clients: Set[AsyncClientConnection] = set()
+
+        self.dh_exchange = get_dh_exchange(**build_conf_of_dh(self.conf))
+
+        self.max_package_size = self.conf["client_tcp_endpoint"].getint("max_package_size", fallback=33554432)
+
+        self.max_in_flight = self.conf["client_tcp_endpoint"].getint("max_in_flight_per_connection", fallback=1)
+        self.request_executor = ThreadPoolExecutor(
+            max_workers=self.conf["client_tcp_endpoint"].getint("request_workers", fallback=32),
+            thread_name_prefix="request")
+
+        self.protocol_version = load_tcp_protocol_version()
+        self.handshake_conf = build_conf_of_handshake(self.conf)
+        self.x25519_handshake = X25519Handshake(server_protocol_version=self.protocol_version)
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop_event: asyncio.Event | None = None
+
+    async def _on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # asyncio already enables it on TCP transports, set it explicitly so both engines match
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        c_handler = AsyncClientConnection(reader, writer, self)
+        logging.info(
+            f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}" + \
+            f"Connected client from {c_handler.client_address[0]}")
+
+        self.clients.add(c_handler)
+        try:
+            await c_handler.handle()
+        finally:
+            self.clients.discard(c_handler)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        server = await asyncio.start_server(
+            self._on_client,
+            host=self.conf["client_tcp_endpoint"]["host"],
+            port=self.conf["client_tcp_endpoint"].getint("port"),
+            backlog=self.conf["client_tcp_endpoint"].getint("max_available_connections"),
+            reuse_address=True,
+            reuse_port=self.conf["client_tcp_endpoint"].getint("workers", fallback=1) > 1
+        )
+
+        self.handling = True
+        logging.info(
+            f"{'Server ' + self.title_ + ' ' if self.title_ else ''}Endpoint started on {
+            self.conf["client_tcp_endpoint"]["host"]
+            }:{self.conf["client_tcp_endpoint"]["port"]} (asyncio)"
+        )
+
+        try:
+            await self._stop_event.wait()
+        finally:
+            server.close()
+
+            for handler in list(self.clients):
+                handler.stop()
+
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if tasks:
+                await asyncio.wait(tasks, timeout=5.0)
+
+            self.request_executor.shutdown(wait=False, cancel_futures=True)
+
+            logging.debug(f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}DH key pool: {self.dh_exchange.cache.stats()}")
+            logging.info(f"Server '{self.title_ + '\' ' if self.title_ else ''}shut down")
+
+    def main(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception:
+            logging.exception(
+                f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}Error in main server loop:")
+
+    def stop(self):
+        logging.info(f"Stopping server '{self.title_ + '\' ' if self.title_ else ''}...")
+        self.handling = False
+
+        if self._loop is not None and self._stop_event is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stop_event.set)
@@ -0,0 +1,117 @@
+import logging
+import struct
+
+from cryptography.hazmat.primitives.asymmetric import dh
+
+from .framing import PACKAGE_HEADER, FRAME_HEADER, OPCODE, OPCODE_FRAMING_PROTOCOL_VERSION, \
+    encode_transaction_code, decode_opcode
+from .handshake import LEGACY_PROTOCOL_VERSION
+from .client_request_handler.session import ClientSession
+from libs.pycrypter import SessionCrypter
+
+
+# Legacy handshake: the client answers the DH parameters with its length-prefixed public value
+DH_PUBLIC_LENGTH = struct.Struct("!I")
+
+
+class ClientProtocol:
+    """Handshake, framing and session crypto of one client connection, shared by both engines.
+
+    It does no I/O: the engine reads the bytes it asks for and writes the bytes it returns, so the
+    threads engine can block on its socket and the asyncio engine can await its stream."""
+
+    def __init__(self, server_instance, client_address):
+        self.server_instance = server_instance
+        self.client_address = client_address
+
+        self.session_key = None
+        self.crypter = None
+        self.session = None
+        self.protocol_version = None
+
+    @property
+    def hello_timeout(self) -> float | None:
+        """How long to wait for a client hello; None waits for it indefinitely."""
+        handshake_conf = self.server_instance.handshake_conf
+        return handshake_conf["hello_timeout"] if handshake_conf["mode"] == "auto" else None
+
+    @property
+    def expects_hello(self) -> bool:
+        return self.server_instance.handshake_conf["mode"] != "legacy"
+
+    def create_dh_handshake(self) -> tuple[dh.DHPrivateKey, bytes]:
+        """Server private key and the server side of the legacy handshake, sent as one buffer."""
+        return self.server_instance.dh_exchange.create_server_handshake()
+
+    def finish_dh_handshake(self, server_private_key: dh.DHPrivateKey, client_public_bytes: bytes):
+        dh_exchange = self.server_instance.dh_exchange
+        self.session_key = dh_exchange.derive_shared_key(
+            server_private_key, int.from_bytes(client_public_bytes, byteorder="big"),
+            dh_exchange.cache.get_parameter_numbers()
+        )
+        self.protocol_version = LEGACY_PROTOCOL_VERSION
+
+    def finish_x25519_handshake(self, hello: bytes) -> bytes:
+        """Returns the server reply to a client hello."""
+        reply, self.session_key, self.protocol_version = self.server_instance.x25519_handshake.respond(hello)
+        return reply
+
+    def start_session(self):
+        self.crypter = SessionCrypter(self.session_key, direction=SessionCrypter.SERVER_TO_CLIENT)
+        self.session = ClientSession(protocol_version=self.protocol_version)
+
+        logging.debug(
+            f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
+            f"Server session key for {self.client_address[0]} (tcp_p{self.protocol_version}): " + \
+            f"{self.session_key.hex()}")
+
+    @property
+    def framed(self) -> bool:
+        return self.protocol_version >= OPCODE_FRAMING_PROTOCOL_VERSION
+
+    @property
+    def header_size(self) -> int:
+        return FRAME_HEADER.size if self.framed else PACKAGE_HEADER.size
+
+    def decode_header(self, header) -> tuple[int, int] | None:
+        """Returns (body length, transaction code length) of a package, None if it is oversized.
+
+        Frames carry their opcode inside the body, their transaction code length is 0."""
+        if self.framed:
+            body_length, = FRAME_HEADER.unpack(header)
+            trans_length = 0
+        else:
+            pkg_length, trans_length = PACKAGE_HEADER.unpack(header)
+            body_length = pkg_length + trans_length
+
+        if body_length > self.server_instance.max_package_size:
+            logging.warning(
+                f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
+                f"Client {self.client_address[0]} sent oversized package ({body_length} bytes)")
+            return None
+
+        return body_length, trans_length
+
+    def decode_body(self, body, trans_length: int) -> tuple[bytes, str]:
+        """Decrypts a package body into (payload, transaction code)."""
+        if self.framed:
+            frame = self.crypter.decrypt(body)
+            opcode, = OPCODE.unpack_from(frame)
+            return frame[OPCODE.size:], decode_opcode(opcode)
+
+        body = memoryview(body)
+        transaction_code = self.crypter.decrypt(body[:trans_length]).decode("utf-8")
+        return self.crypter.decrypt(body[trans_length:]), transaction_code
+
+    def encode_package(self, pkg: bytes, transaction_code: str) -> bytearray:
+        if self.framed:
+            pkg_data = bytearray(FRAME_HEADER.pack(OPCODE.size + len(pkg) + SessionCrypter.OVERHEAD))
+            self.crypter.encrypt_into(pkg_data, OPCODE.pack(encode_transaction_code(transaction_code)) + pkg)
+        else:
+            trans_code_bytes = transaction_code.encode("utf-8")
+            pkg_data = bytearray(PACKAGE_HEADER.pack(
+                len(pkg) + SessionCrypter.OVERHEAD, len(trans_code_bytes) + SessionCrypter.OVERHEAD))
+            self.crypter.encrypt_into(pkg_data, trans_code_bytes)
+            self.crypter.encrypt_into(pkg_data, pkg)
+
+        return pkg_data
@@ -1 +1,140 @@
+import secrets
+
+from hmac import compare_digest
+
 from ..db_api import MainAppDatabaseAPI
+from .auth import authenticator
+from .envelope import Response, StreamedResponse
+from .registry import OptionalArg, transactions
+from .session import ClientSession
+
+
+# Page size of streamed message reads and upper bound of a client's ``limit``
+MESSAGES_PAGE_SIZE = 200
+MAX_MESSAGES_LIMIT = 1000
+
+
+def _check_access(db_api: MainAppDatabaseAPI, username: str, password: str,
+                  session: ClientSession | None = None) -> bool:
+    """True if the connection already authenticated as ``username``, else verifies the password."""
+    if session is not None and session.is_authenticated(username):
+        return True
+
+    if not authenticator.check(username, password, db_api.get_password_hash):
+        return False
+
+    if session is not None:
+        session.authenticate(username)
+    return True
+
+
+@transactions.register("REGISTER_ACCOUNT", username=str, password_hash=str)
+def register_account(db_api: MainAppDatabaseAPI, username: str, password_hash: str):
+    if not db_api.create_account(username, authenticator.hasher.hash(password_hash)):
+        return Response("user_already_exists", "REGISTER_ACCOUNT")
+
+    return Response("ok", "REGISTER_ACCOUNT")
+
+
+@transactions.register("GEN_VERIFY_TOKEN", username=str, password=str)
+def gen_verify_token(db_api: MainAppDatabaseAPI, username: str, password: str, session: ClientSession | None = None):
+    if not _check_access(db_api, username, password, session):
+        return Response("access_denied", "GEN_VERIFY_TOKEN")
+
+    verify_token = secrets.token_urlsafe(32)
+    db_api.set_verify_token(username, verify_token)
+
+    return Response("ok", "GEN_VERIFY_TOKEN", {"verify_token": verify_token})
+
+
+@transactions.register("CHECK_ACCOUNT_ACCESS_BY_PASSWORD", username=str, password=str)
+def check_account_access_by_password(db_api: MainAppDatabaseAPI, username: str, password: str,
+                                     session: ClientSession | None = None):
+    if not _check_access(db_api, username, password, session):
+        return Response("access_denied", "CHECK_ACCOUNT_ACCESS_BY_PASSWORD")
+
+    return Response("ok", "CHECK_ACCOUNT_ACCESS_BY_PASSWORD")
+
+
+@transactions.register("VERIFY_TOKEN", target_username=str, token=str)
+def verify_token(db_api: MainAppDatabaseAPI, target_username: str, token: str):
+    # Checks another account's token for the caller, it doesn't log the connection in as target_username
+    stored_token = db_api.get_verify_token(target_username)
+    if stored_token is None or not compare_digest(stored_token, token):
+        return Response("invalid_token", "VERIFY_TOKEN")
+
+    return Response("ok", "VERIFY_TOKEN")
+
+
+@transactions.register("SEND_MSG", chat_uuid=str, username=str, password=str, percipient=str, payload=(bytes, str))
+def send_msg(db_api: MainAppDatabaseAPI, chat_uuid: str, username: str, password: str, percipient: str,
+             payload: bytes | str, session: ClientSession | None = None):
+    if not _check_access(db_api, username, password, session):
+        return Response("access_denied", "SEND_MSG")
+
+    # msgpack clients send raw bytes, JSON clients can only send text
+    if isinstance(payload, str):
+        payload = payload.encode(encoding="utf-8")
+
+    message_id = db_api.add_message(chat_uuid, username, percipient, payload)
+
+    return Response("ok", "SEND_MSG", {"message_id": message_id})
+
+
+@transactions.register("UPDATE_PDS", username=str, password=str, pds=list)
+def update_pds(db_api: MainAppDatabaseAPI, username: str, password: str, pds: list,
+               session: ClientSession | None = None):
+    if not _check_access(db_api, username, password, session):
+        return Response("access_denied", "UPDATE_PDS")
+
+    if not all(isinstance(message_id, int) and not isinstance(message_id, bool) for message_id in pds):
+        return Response("invalid_arguments", "UPDATE_PDS")
+
+    db_api.set_pds(username, pds)
+
+    return Response("ok", "UPDATE_PDS")
+
+
+def _read_messages(db_api: MainAppDatabaseAPI, transaction_code: str, username: str, last_num: int,
+                   chat_uuid: str | None, limit: int | None):
+    if limit is None:
+        return StreamedResponse(transaction_code, _message_pages(db_api, username, last_num, chat_uuid), "messages")
+
+    if limit <= 0:
+        return Response("invalid_arguments", transaction_code)
+
+    # One row past the page tells whether another page follows
+    limit = min(limit, MAX_MESSAGES_LIMIT)
+    messages = db_api.get_messages(username, last_num, chat_uuid, limit=limit + 1)
+
+    return Response("ok", transaction_code, {"messages": messages[:limit], "more": len(messages) > limit})
+
+
+def _message_pages(db_api: MainAppDatabaseAPI, username: str, last_num: int, chat_uuid: str | None):
+    while True:
+        page = db_api.get_messages(username, last_num, chat_uuid, limit=MESSAGES_PAGE_SIZE)
+        if page:
+            yield page
+        if len(page) < MESSAGES_PAGE_SIZE:
+            return
+
+        last_num = page[-1]["id"]
+
+
+@transactions.register("READ_ALL_MESSAGES", username=str, password=str, last_num=int, limit=OptionalArg(int))
+def read_all_messages(db_api: MainAppDatabaseAPI, username: str, password: str, last_num: int, limit: int | None,
+                      session: ClientSession | None = None):
+    if not _check_access(db_api, username, password, session):
+        return Response("access_denied", "READ_ALL_MESSAGES")
+
+    return _read_messages(db_api, "READ_ALL_MESSAGES", username, last_num, None, limit)
+
+
+@transactions.register("READ_MESSAGES_OF_CHAT", username=str, password=str, last_num=int, chat_uuid=str,
+                       limit=OptionalArg(int))
+def read_messages_of_chat(db_api: MainAppDatabaseAPI, username: str, password: str, last_num: int, chat_uuid: str,
+                          limit: int | None, session: ClientSession | None = None):
+    if not _check_access(db_api, username, password, session):
+        return Response("access_denied", "READ_MESSAGES_OF_CHAT")
+
+    return _read_messages(db_api, "READ_MESSAGES_OF_CHAT", username, last_num, chat_uuid, limit)
@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from configparser import ConfigParser
+from typing import Callable
+
+from libs.pycrypter import hash_password, verify_password
+
+
+class CredentialCache:
+    """Bounded LRU of recently verified (username, password) pairs, each valid for ``ttl`` seconds.
+
+    Passwords are kept only as an HMAC under a per-process random key, never in plain text."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max(0, int(max_size))
+        self.ttl = float(ttl)
+
+        self._entries: OrderedDict[tuple[str, bytes], float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._secret = secrets.token_bytes(32)
+
+    def _key(self, username: str, password: str) -> tuple[str, bytes]:
+        return username, hmac.new(self._secret, password.encode(), hashlib.sha256).digest()
+
+    def contains(self, username: str, password: str) -> bool:
+        if self.max_size == 0:
+            return False
+
+        key = self._key(username, password)
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False
+
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, username: str, password: str):
+        if self.max_size == 0:
+            return
+
+        key = self._key(username, password)
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class PasswordHasher:
+    """Runs the slow password hash in a process pool, so it neither holds the GIL of the request workers
+    nor competes with them for a core. ``workers`` <= 0 hashes inline."""
+
+    def __init__(self, workers: int = 2):
+        self.workers = int(workers)
+
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor | None:
+        if self.workers <= 0:
+            return None
+
+        # Created lazily per process: prefork workers must not share the master's pool. Spawned, not forked,
+        # since forking a process that already runs threads can deadlock the child
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                self._pool_pid = os.getpid()
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+            return self._pool
+
+    def hash(self, password: str) -> str:
+        executor = self._executor()
+        if executor is None:
+            return hash_password(password)
+        return executor.submit(hash_password, password).result()
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        executor = self._executor()
+        if executor is None:
+            return verify_password(password, password_hash)
+        return executor.submit(verify_password, password, password_hash).result()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._pool_pid = None
+
+
+class Authenticator:
+    """Password checks of the transaction handlers: a cached credential skips both the stored hash lookup
+    and hashing, a miss is verified on the PasswordHasher."""
+
+    def __init__(self, hasher: PasswordHasher | None = None, cache: CredentialCache | None = None):
+        self.hasher = hasher or PasswordHasher(workers=0)
+        self.cache = cache or CredentialCache()
+
+    def configure(self, app_conf: ConfigParser):
+        self.hasher.close()
+        self.hasher = PasswordHasher(workers=app_conf.getint("auth", "hash_workers", fallback=2))
+        self.cache = CredentialCache(max_size=app_conf.getint("auth", "credential_cache_size", fallback=10000),
+                                     ttl=app_conf.getfloat("auth", "credential_cache_ttl", fallback=300.0))
+
+    def check(self, username: str, password: str, load_password_hash: Callable[[str], str | None]) -> bool:
+        if self.cache.contains(username, password):
+            return True
+
+        password_hash = load_password_hash(username)
+        if password_hash is None or not self.hasher.verify(password, password_hash):
+            return False
+
+        self.cache.add(username, password)
+        return True
+
+    def close(self):
+        self.hasher.close()
+
+
+authenticator = Authenticator()
@@ -0,0 +1,82 @@
+import base64
+import json
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Protocol >= 17 carries request/response bodies as msgpack, so message payloads stay raw bytes end to end
+BINARY_CODEC_PROTOCOL_VERSION = 17
+
+
+# JSON form of bytes that aren't UTF-8 text, e.g. an image sent by a msgpack client: {"$base64": "<data>"}
+BASE64_MARKER = "$base64"
+
+
+def _bytes_to_text(obj):
+    # JSON has no bytes type; payloads of protocol <= 16 clients were sent as text, so they round-trip as text.
+    # Anything else goes out base64 encoded rather than lossily decoded
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        try:
+            return data.decode(encoding="utf-8")
+        except UnicodeDecodeError:
+            return {BASE64_MARKER: base64.b64encode(data).decode(encoding="ascii")}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    name = "json"
+    decode_errors = (ValueError, UnicodeDecodeError)
+
+    @staticmethod
+    def loads(data: bytes):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, default=_bytes_to_text).encode(encoding="utf-8")
+
+
+class OrjsonCodec(JsonCodec):
+    """Same wire format as JsonCodec, several times faster; used when orjson is installed."""
+
+    decode_errors = (ValueError,)
+
+    @staticmethod
+    def loads(data: bytes):
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=_bytes_to_text)
+
+
+class MsgpackCodec:
+    """Binary codec: msgpack ``bin`` values decode to bytes and bytes encode as ``bin``, with no text transcoding."""
+
+    name = "msgpack"
+    decode_errors = (ValueError, TypeError)
+
+    @staticmethod
+    def loads(data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+
+JSON_CODEC = OrjsonCodec() if orjson is not None else JsonCodec()
+MSGPACK_CODEC = MsgpackCodec()
+
+
+def get_codec(protocol_version: int | None):
+    if protocol_version is not None and protocol_version >= BINARY_CODEC_PROTOCOL_VERSION:
+        return MSGPACK_CODEC
+
+    return JSON_CODEC
@@ -1,63 +1,57 @@
-from importlib import import_module
-from pathlib import Path
+import logging
 
-import json
+from typing import Iterator
 
 from ..db_api import MainAppDatabaseAPI
+from ..handshake import LEGACY_PROTOCOL_VERSION
+from . import app_functions  # noqa: F401 - registers the transaction handlers
+from .codecs import get_codec
+from .envelope import STREAMED_RESPONSES_PROTOCOL_VERSION, Request, Response, StreamedResponse
+from .registry import transactions
+from .session import ClientSession
 
 
-def add_request_uuid_to_response(response_data: bytes, request_uuid: str = None) -> bytes:
-    if not request_uuid:
-        return response_data
-
-    try:
-        response_json = json.loads(response_data.decode(encoding="utf-8"))
-        if isinstance(response_json, tuple) and len(response_json) == 2:
-            result, data = response_json
-            if data is None:
-                data = {}
-            elif not isinstance(data, dict):
-                data = {"data": data}
-
-            data["request_uuid"] = request_uuid
-            return json.dumps((result, data)).encode(encoding="utf-8")
-        else:
-            return response_data
-
-    except (json.JSONDecodeError, UnicodeDecodeError, UnicodeEncodeError):
-        return response_data
+def dispatch(request: Request, db_api: MainAppDatabaseAPI,
+             session: ClientSession | None = None) -> Response | StreamedResponse:
+    transaction = transactions.get(request.transaction_code)
+    if transaction is None:
+        return Response("invalid_transaction_code", request.transaction_code)
 
+    if not transaction.accepts(request.args):
+        return Response("invalid_arguments", request.transaction_code)
 
-def cr_handler(transaction_code: str, pkg: bytes, db_api: MainAppDatabaseAPI) -> (bytes, str):
-    request_uuid = None
+    args = transaction.bind(request.args)
+    if transaction.takes_session:
+        args = {**args, "session": session}
 
     try:
-        pkg_data = json.loads(pkg.decode(encoding="utf-8"))
-        if isinstance(pkg_data, dict) and "request_uuid" in pkg_data:
-            request_uuid = pkg_data.pop("request_uuid")
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        pkg_data = {}
+        return transaction.func(db_api=db_api, **args)
+    except Exception:
+        logging.exception(f"Transaction '{request.transaction_code}' failed")
+        return Response("internal_error", request.transaction_code)
 
+
+def cr_handler(transaction_code: str, pkg: bytes, db_api: MainAppDatabaseAPI,
+               session: ClientSession | None = None) -> tuple[bytes, str] | Iterator[tuple[bytes, str]]:
+    """Returns one (response, response type) pair, or an iterator of them for a streamed response."""
     if transaction_code == "CONNECTION_TEST":
-        original_pkg = pkg.decode(encoding="utf-8")
-        response_data = original_pkg.encode(encoding="utf-8")
+        return bytes(pkg), "CONNECTION_TEST:RESPONSE"
 
-        return add_request_uuid_to_response(response_data, request_uuid), "CONNECTION_TEST:RESPONSE"
-    else:
-        if pkg_data is None:
-            pkg_data = {}
+    protocol_version = session.protocol_version if session is not None else LEGACY_PROTOCOL_VERSION
+    codec = get_codec(protocol_version)
 
-        try:
-            module = import_module(name=".app_functions", package=__package__)
-            response_data, response_type = getattr(module, transaction_code.lower())(db_api=db_api, **pkg_data)
-            return add_request_uuid_to_response(response_data, request_uuid), response_type
+    request = Request.decode(transaction_code, pkg, codec)
+    response = dispatch(request, db_api, session)
+    response.request_uuid = request.request_uuid
 
-        except AttributeError:
-            data_dir = str(Path(__file__).resolve().parent.parent.parent) + "/data"
-            error_codes_file = data_dir + "/fuh_exit_codes.json"
-            error_codes = json.loads(open(file=error_codes_file, mode="r", encoding="UTF-8").read())
+    if isinstance(response, StreamedResponse):
+        if protocol_version >= STREAMED_RESPONSES_PROTOCOL_VERSION:
+            return response.encode_frames(codec)
 
-            result = next(item for item in error_codes if item[0] == "invalid_transaction_code")
-            response_data = json.dumps((result, None)).encode()
+        try:
+            response = response.collect()
+        except Exception:
+            logging.exception(f"Transaction '{request.transaction_code}' failed")
+            response = Response("internal_error", request.transaction_code, request_uuid=request.request_uuid)
 
-            return add_request_uuid_to_response(response_data, request_uuid), "ERROR:RESPONSE"
+    return response.encode(codec), response.response_type
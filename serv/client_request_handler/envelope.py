@@ -0,0 +1,111 @@
+from pathlib import Path
+from typing import Dict, Iterable, Iterator
+
+import json
+import logging
+
+
+DATA_DIR = str(Path(__file__).resolve().parent.parent.parent) + "/data"
+
+ERROR_CODES_FILE = DATA_DIR + "/fuh_exit_codes.json"
+
+# Protocol >= 18 clients accept a response split over several frames, see StreamedResponse
+STREAMED_RESPONSES_PROTOCOL_VERSION = 18
+
+
+def load_exit_codes(file: str = ERROR_CODES_FILE) -> Dict[str, list]:
+    with open(file=file, mode="r", encoding="UTF-8") as error_codes_file:
+        return {item[0]: item for item in json.loads(error_codes_file.read())}
+
+
+EXIT_CODES = load_exit_codes()
+
+
+class Request:
+    __slots__ = ("transaction_code", "args", "request_uuid")
+
+    def __init__(self, transaction_code: str, args: dict, request_uuid: str | None = None):
+        self.transaction_code = transaction_code
+        self.args = args
+        self.request_uuid = request_uuid
+
+    @classmethod
+    def decode(cls, transaction_code: str, pkg: bytes, codec) -> "Request":
+        """Parses the package once; anything that is not an object decodes to empty arguments."""
+        try:
+            args = codec.loads(pkg)
+        except codec.decode_errors:
+            args = {}
+
+        if not isinstance(args, dict):
+            args = {}
+
+        return cls(transaction_code=transaction_code, args=args, request_uuid=args.pop("request_uuid", None))
+
+
+class Response:
+    __slots__ = ("result", "transaction_code", "data", "request_uuid")
+
+    def __init__(self, result: str, transaction_code: str, data=None, request_uuid: str | None = None):
+        self.result = result
+        self.transaction_code = transaction_code
+        self.data = data
+        self.request_uuid = request_uuid
+
+    @property
+    def response_type(self) -> str:
+        return "ERROR:RESPONSE" if self.result != "ok" else self.transaction_code + ":RESPONSE"
+
+    def encode(self, codec) -> bytes:
+        """Serializes ``[<exit code item>, <data>]`` exactly once, with request_uuid merged into data."""
+        data = self.data
+        if self.request_uuid is not None:
+            if data is None:
+                data = {}
+            elif not isinstance(data, dict):
+                data = {"data": data}
+            data["request_uuid"] = self.request_uuid
+
+        return codec.dumps((EXIT_CODES[self.result], data))
+
+
+class StreamedResponse:
+    """Successful response whose ``data_key`` list is produced page by page.
+
+    Clients of protocol >= 18 get one frame per page, each carrying ``more: true`` except the last;
+    older clients get the pages collected into a single Response."""
+
+    __slots__ = ("transaction_code", "pages", "data_key", "request_uuid")
+
+    def __init__(self, transaction_code: str, pages: Iterable[list], data_key: str, request_uuid: str | None = None):
+        self.transaction_code = transaction_code
+        self.pages = pages
+        self.data_key = data_key
+        self.request_uuid = request_uuid
+
+    def _frame(self, page: list, more: bool, codec) -> tuple[bytes, str]:
+        response = Response("ok", self.transaction_code, {self.data_key: page, "more": more}, self.request_uuid)
+        return response.encode(codec), response.response_type
+
+    def encode_frames(self, codec) -> Iterator[tuple[bytes, str]]:
+        """Encodes lazily, one page ahead of the frame being sent; a failing page ends the stream with internal_error."""
+        try:
+            pages = iter(self.pages)
+            page = next(pages, [])
+            for next_page in pages:
+                yield self._frame(page, True, codec)
+                page = next_page
+
+        except Exception:
+            logging.exception(f"Streaming '{self.transaction_code}' response failed")
+            response = Response("internal_error", self.transaction_code, request_uuid=self.request_uuid)
+            yield response.encode(codec), response.response_type
+            return
+
+        yield self._frame(page, False, codec)
+
+    def collect(self) -> Response:
+        """All pages in one Response, shaped like the last frame of a stream (``more: false``)."""
+        return Response("ok", self.transaction_code,
+                        {self.data_key: [item for page in self.pages for item in page], "more": False},
+                        self.request_uuid)
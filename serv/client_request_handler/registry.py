@@ -0,0 +1,73 @@
+import inspect
+
+from typing import Callable, Dict
+
+from ..framing import TRANSACTION_OPCODES
+
+
+class OptionalArg:
+    """Schema entry for an argument the client may omit; the handler then receives ``default``."""
+
+    def __init__(self, type_: type | tuple[type, ...], default=None):
+        self.type_ = type_
+        self.default = default
+
+
+class Transaction:
+    def __init__(self, code: str, func: Callable, schema: Dict[str, type | tuple[type, ...] | OptionalArg]):
+        self.code = code
+        self.func = func
+        self.schema = schema
+
+        # Handlers declaring a ``session`` parameter also receive the connection's ClientSession
+        self.takes_session = "session" in inspect.signature(func).parameters
+
+        self.required = {name for name, type_ in schema.items() if not isinstance(type_, OptionalArg)}
+        self.defaults = {name: type_.default for name, type_ in schema.items() if isinstance(type_, OptionalArg)}
+
+    def accepts(self, args: dict) -> bool:
+        if not self.required <= args.keys() <= self.schema.keys():
+            return False
+
+        for name, value in args.items():
+            type_ = self.schema[name]
+            types = type_.type_ if isinstance(type_, OptionalArg) else type_
+            if not isinstance(value, types):
+                return False
+            # bool is an int subclass, but true/false is no valid count or id
+            if isinstance(value, bool) and bool not in (types if isinstance(types, tuple) else (types,)):
+                return False
+
+        return True
+
+    def bind(self, args: dict) -> dict:
+        """Accepted arguments with the defaults of omitted optional ones filled in."""
+        return {**self.defaults, **args} if self.defaults else args
+
+
+class TransactionRegistry:
+    def __init__(self):
+        self._transactions: Dict[str, Transaction] = {}
+
+    def register(self, code: str, **schema: type | tuple[type, ...] | OptionalArg):
+        """Decorator: registers the handler for ``code``, keyword arguments declare its argument types."""
+        def decorator(func: Callable) -> Callable:
+            if code in self._transactions:
+                raise ValueError(f"Transaction '{code}' is already registered")
+            # Protocol >= 16 clients address transactions by opcode, one without it could never be answered
+            if code not in TRANSACTION_OPCODES:
+                raise ValueError(f"Transaction '{code}' has no opcode in framing.TRANSACTION_OPCODES")
+
+            self._transactions[code] = Transaction(code=code, func=func, schema=schema)
+            return func
+
+        return decorator
+
+    def get(self, code: str) -> Transaction | None:
+        return self._transactions.get(code)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self._transactions
+
+
+transactions = TransactionRegistry()
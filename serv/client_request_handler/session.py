@@ -0,0 +1,15 @@
+class ClientSession:
+    """Per-connection state shared by every request of one client connection."""
+
+    def __init__(self, protocol_version: int):
+        self.protocol_version = protocol_version
+
+        # Account whose password was verified on this connection (CHECK_ACCOUNT_ACCESS_BY_PASSWORD,
+        # GEN_VERIFY_TOKEN or any other password-checked transaction)
+        self.username: str | None = None
+
+    def authenticate(self, username: str):
+        self.username = username
+
+    def is_authenticated(self, username: str) -> bool:
+        return self.username is not None and self.username == username
@@ -27,7 +27,21 @@ def load_config(file: str):
                 "role_passwd": "< change these field in config file >",
                 "db_host": "localhost",
                 "db_port": 5432,
-                "db_name": "shadow_wire_db"
+                "db_name": "shadow_wire_db",
+                "pool_min_size": 2,
+                "pool_max_size": 16,
+                "pool_timeout": 5.0,
+                "health_check_interval": 30.0,
+                "write_batch_interval": 0.002,
+                "write_batch_size": 256,
+                "crypt_workers": 0
+            }
+
+        config["auth"] = \
+            {
+                "hash_workers": 2,
+                "credential_cache_size": 10000,
+                "credential_cache_ttl": 300.0
             }
 
         config["logging"] = \
@@ -39,7 +53,23 @@ def load_config(file: str):
             {
                 "host": "0.0.0.0",
                 "port": "5477",
-                "max_available_connections": 950
+                "max_available_connections": 950,
+                "max_package_size": 33554432,
+                "request_workers": 32,
+                "max_in_flight_per_connection": 1,
+                "send_timeout": 30.0,
+                "engine": "threads",
+                "workers": 1,
+                "handshake": "auto",
+                "hello_timeout": 0.25
+            }
+
+        config["dh"] = \
+            {
+                "key_size": 2048,
+                "pool_size": 128,
+                "pool_low_watermark": 32,
+                "params_file": DATA_DIR + "/dh_params.pem"
             }
 
         with open(file=file, mode="w", encoding="UTF-8") as configfile:
@@ -7,7 +7,10 @@ from importlib import import_module
 from pathlib import Path
 
 from .tcp_server import TCPServer
+from .async_tcp_server import AsyncTCPServer
+from .workers import WorkerSupervisor
 
+from .client_request_handler.auth import authenticator
 from .client_request_handler.cr_handler import cr_handler as crh
 from .config_parser import load_config
 from .db_api import MainAppDatabaseAPI
@@ -21,16 +24,21 @@ VERSION_FILE = DATA_DIR + "/vers/server_version"
 CRYPT_TCP_PROTOCOL_VERSION_FILE = DATA_DIR + "/vers/crypt_tcp_protocol_version"
 CRYPT_DB_PROTOCOL_VERSION_FILE = DATA_DIR + "/vers/crypt_db_protocol_version"
 
+TCP_SERVER_ENGINES = {
+    "threads": TCPServer,
+    "asyncio": AsyncTCPServer
+}
+
 
 def load_version() -> (str, int, int):
     with open(file=VERSION_FILE, mode="r", encoding="UTF-8") as vers_file:
-        vers = str(vers_file.readline(0))
+        vers = str(vers_file.readline().strip())
 
     with open(file=CRYPT_TCP_PROTOCOL_VERSION_FILE, mode="r", encoding="UTF-8") as proto_vers_file_tcp:
-        crypt_tcp_proto_vers = int(proto_vers_file_tcp.readline(0))
+        crypt_tcp_proto_vers = int(proto_vers_file_tcp.readline().strip())
 
     with open(file=CRYPT_DB_PROTOCOL_VERSION_FILE, mode="r", encoding="UTF-8") as proto_vers_file_db:
-        crypt_db_proto_vers = int(proto_vers_file_db.readline(0))
+        crypt_db_proto_vers = int(proto_vers_file_db.readline().strip())
 
     return vers, crypt_tcp_proto_vers, crypt_db_proto_vers
 
@@ -48,9 +56,10 @@ class ServiceCore:
         logging.info(f"Service core initialized [{self.version} " + \
                      f"tcp_p{self.crypt_tcp_protocol_version} db_p{self.crypt_db_protocol_version}]")
 
-        self.c_tcp_serv = TCPServer(conf=self.conf, request_handle_func=crh)
+        self.c_tcp_serv = self._make_tcp_server()
 
         self.__setup_db__()
+        authenticator.configure(app_conf=self.conf)
         self.__setup_signal_handlers__()
         self._stopping = False
 
@@ -70,18 +79,35 @@ class ServiceCore:
             ]
         )
 
+    def _make_tcp_server(self):
+        engine = self.conf["client_tcp_endpoint"].get("engine", fallback="threads")
+        if engine not in TCP_SERVER_ENGINES:
+            raise ValueError(f"Unknown client_tcp_endpoint engine '{engine}', " + \
+                             f"expected one of: {', '.join(TCP_SERVER_ENGINES)}")
+
+        if self.conf["client_tcp_endpoint"].getint("workers", fallback=1) > 1:
+            return WorkerSupervisor(conf=self.conf, request_handle_func=crh, server_cls=TCP_SERVER_ENGINES[engine])
+
+        return TCP_SERVER_ENGINES[engine](conf=self.conf, request_handle_func=crh)
+
     def __setup_db__(self):
-        self.db_api = MainAppDatabaseAPI()
+        self.db_api = MainAppDatabaseAPI(app_conf=self.conf)
 
     def _define_cr_server(self):
-        def request_handler_constructor(transaction_code, pkg):
-            return crh(transaction_code=transaction_code, pkg=pkg, db_api=self.db_api)
+        def request_handler_constructor(transaction_code, pkg, session=None):
+            return crh(transaction_code=transaction_code, pkg=pkg, db_api=self.db_api, session=session)
 
         self.c_tcp_serv.request_handle_func = request_handler_constructor
         self.c_tcp_serv.title_ = "CRH"
 
     def _start(self):
         self._define_cr_server()
+
+        if isinstance(self.c_tcp_serv, WorkerSupervisor):
+            # Workers are forked from this process; drop the master's DB connections so
+            # each worker opens its own pool instead of sharing sockets
+            self.db_api.db.close()
+
         self.c_tcp_serv.main()
 
     def _stop(self):
@@ -106,3 +132,5 @@ class ServiceCore:
             logging.error(f"Unexpected error: {e}")
         finally:
             self._stop()
+            self.db_api.close()
+            authenticator.close()
@@ -1,12 +1,55 @@
 import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
 from contextlib import contextmanager
-from typing import Any, Optional, Sequence, Union, Literal
+from typing import Any, Iterator, Optional, Sequence, Union, Literal
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 
 
 FetchMode = Literal["none", "one", "all", "val"]
+RowMode = Literal["dict", "tuple", "namedtuple"]
+
+# Cursor per row mode; RealDictCursor builds the dicts directly instead of DictRow + a dict() copy
+ROW_CURSORS = {
+	"dict": psycopg2.extras.RealDictCursor,
+	"tuple": psycopg2.extensions.cursor,
+	"namedtuple": psycopg2.extras.NamedTupleCursor,
+}
+
+# Errors after which a connection can't be trusted anymore and is dropped instead of going back to the pool
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+_PARAM_RE = re.compile(r"%%|%s")
+_QUERY_NAME_RE = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def to_numbered_query(query: str) -> tuple[str, int]:
+	"""Rewrites psycopg2 ``%s`` placeholders to PostgreSQL ``$n`` ones, returning the query and its parameter count."""
+	count = 0
+
+	def replace(match):
+		nonlocal count
+		if match.group(0) == "%%":
+			return "%"
+		count += 1
+		return f"${count}"
+
+	return _PARAM_RE.sub(replace, query), count
+
+
+class PooledConnection(psycopg2.extensions.connection):
+	"""Remembers which registered queries are already PREPAREd in this session."""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.prepared = set()
 
 
 class PDB:
@@ -20,8 +63,11 @@ class PDB:
 		password: Optional[str] = None,
 		sslmode: Optional[str] = None,
 		autocommit: bool = False,
+		pool_min_size: int = 1,
+		pool_max_size: int = 1,
+		pool_timeout: float = 5.0,
+		health_check_interval: float = 30.0,
 	):
-		self._conn = None
 		self._conn_kwargs = {
 			"dsn": dsn,
 			"host": host,
@@ -33,84 +79,279 @@ class PDB:
 		}
 		self._autocommit = bool(autocommit)
 
-	def connect(self):
-		if self._conn is not None:
-			return self._conn
-		conn = psycopg2.connect(**{k: v for k, v in self._conn_kwargs.items() if v is not None}, cursor_factory=psycopg2.extras.DictCursor)
+		self.pool_min_size = max(0, int(pool_min_size))
+		self.pool_max_size = max(1, int(pool_max_size), self.pool_min_size)
+		self.pool_timeout = float(pool_timeout)
+		self.health_check_interval = float(health_check_interval)
+
+		# Idle connections as (connection, returned at), most recently used last
+		self._idle = deque()
+		self._opened = 0
+		self._closed = False
+		self._pool_cond = threading.Condition()
+		self._pid = os.getpid()
+
+		# Connection checked out by transaction() for the current thread
+		self._local = threading.local()
+
+		# name -> (query with $n placeholders, number of parameters), see prepare()
+		self._queries = {}
+
+	def _open_connection(self):
+		conn = psycopg2.connect(**{k: v for k, v in self._conn_kwargs.items() if v is not None}, connection_factory=PooledConnection, cursor_factory=psycopg2.extras.DictCursor)
 		conn.autocommit = self._autocommit
-		self._conn = conn
 		return conn
 
-	def close(self):
-		if self._conn:
+	def _reset_after_fork(self):
+		# Sockets inherited from the parent belong to its sessions; forget them without closing
+		if self._pid != os.getpid():
+			self._pid = os.getpid()
+			self._idle.clear()
+			self._opened = 0
+			self._local = threading.local()
+
+	def _is_healthy(self, conn, idle_since: float) -> bool:
+		if conn.closed:
+			return False
+		if time.monotonic() - idle_since < self.health_check_interval:
+			return True
+
+		try:
+			with conn.cursor() as cur:
+				cur.execute("SELECT 1")
+			if not self._autocommit:
+				conn.rollback()
+			return True
+		except CONNECTION_ERRORS:
+			return False
+
+	@staticmethod
+	def _discard_connection(conn):
+		try:
+			conn.close()
+		except Exception:
+			pass
+
+	def _check_open(self):
+		if self._closed:
+			raise psycopg2.pool.PoolError("Connection pool is closed")
+
+	def connect(self):
+		"""Opens connections up to pool_min_size."""
+		with self._pool_cond:
+			self._check_open()
+			self._reset_after_fork()
+			while self._opened < self.pool_min_size:
+				self._idle.append((self._open_connection(), time.monotonic()))
+				self._opened += 1
+
+	def _take_idle_or_slot(self, deadline: float):
+		"""Pops an idle (connection, idle since) pair, or reserves a slot for a new connection (None)."""
+		with self._pool_cond:
+			self._reset_after_fork()
+			while True:
+				self._check_open()
+				if self._idle:
+					return self._idle.pop()
+
+				if self._opened < self.pool_max_size:
+					self._opened += 1
+					return None
+
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise psycopg2.pool.PoolError(
+						f"No free database connection after {self.pool_timeout}s (pool_max_size = {self.pool_max_size})")
+				self._pool_cond.wait(remaining)
+
+	def _checkout(self):
+		deadline = time.monotonic() + self.pool_timeout
+
+		# Health checks and reconnects run outside the lock, a slow server must not block checkins of other threads
+		while True:
+			idle = self._take_idle_or_slot(deadline)
+			if idle is None:
+				break
+
+			conn, idle_since = idle
+			if self._is_healthy(conn, idle_since):
+				return conn
+
+			self._discard_connection(conn)
+			with self._pool_cond:
+				self._opened -= 1
+				self._pool_cond.notify()
+
+		try:
+			return self._open_connection()
+		except Exception:
+			with self._pool_cond:
+				self._opened -= 1
+				self._pool_cond.notify()
+			raise
+
+	def _checkin(self, conn, broken: bool = False):
+		if not broken and not conn.closed and not self._autocommit:
 			try:
-				self._conn.close()
-			except Exception:
-				pass
-			finally:
-				self._conn = None
+				if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+					conn.rollback()
+			except CONNECTION_ERRORS:
+				broken = True
+
+		with self._pool_cond:
+			if self._closed:
+				# Returned by a request that outlived close(), nothing will check it out again
+				self._discard_connection(conn)
+				self._opened -= 1
+			elif broken or conn.closed:
+				self._discard_connection(conn)
+				self._opened -= 1
+				# Likely a server restart or network drop: health-check every idle connection before reuse
+				self._idle = deque((idle_conn, float("-inf")) for idle_conn, _ in self._idle)
+			else:
+				self._idle.append((conn, time.monotonic()))
+			self._pool_cond.notify()
+
+	def close(self):
+		"""Closes the idle connections; checked out ones are closed when they are checked in, and further
+		checkouts raise PoolError."""
+		with self._pool_cond:
+			self._closed = True
+			while self._idle:
+				conn, _ = self._idle.pop()
+				self._opened -= 1
+				self._discard_connection(conn)
+			self._pool_cond.notify_all()
+
+	def pool_stats(self) -> dict:
+		with self._pool_cond:
+			return {"opened": self._opened, "idle": len(self._idle), "max_size": self.pool_max_size}
 
 	@property
 	def conn(self):
-		return self._conn or self.connect()
+		"""Connection of the current thread's transaction()."""
+		conn = getattr(self._local, "conn", None)
+		if conn is None:
+			raise RuntimeError("PDB.conn is only available inside PDB.transaction()")
+		return conn
 
 	def cursor(self):
 		return self.conn.cursor()
 
+	@staticmethod
+	def _fetch(cur, fetch: FetchMode):
+		if fetch == "one":
+			return cur.fetchone()
+		elif fetch == "all":
+			return cur.fetchall()
+		elif fetch == "val":
+			row = cur.fetchone()
+			return (row[0] if row is not None and len(row) > 0 else None)
+		return None
+
+	def _run(self, prepare, fetch: FetchMode, rows: RowMode, commit: bool):
+		conn = getattr(self._local, "conn", None)
+		if conn is None:
+			with self.transaction():
+				return self._run(prepare, fetch, rows, commit=False)
+
+		with conn.cursor(cursor_factory=ROW_CURSORS["tuple" if fetch == "val" else rows]) as cur:
+			prepare(conn, cur)
+			result = self._fetch(cur, fetch)
+		if commit and not self._autocommit:
+			conn.commit()
+		return result
+
 	def execute(
 		self,
 		query: str,
 		params: Optional[Union[Sequence[Any], dict]] = None,
 		fetch: FetchMode = "none",
 		commit: bool = False,
+		rows: RowMode = "dict",
 	):
-		with self.cursor() as cur:
-			cur.execute(query, params)
-			result = None
-			if fetch == "one":
-				row = cur.fetchone()
-				result = dict(row) if row is not None else None
-			elif fetch == "all":
-				rows = cur.fetchall()
-				result = [dict(r) for r in rows]
-			elif fetch == "val":
-				row = cur.fetchone()
-				result = (row[0] if row is not None and len(row) > 0 else None)
-
-			if commit or (self._autocommit is False and fetch == "none"):
-				self.conn.commit()
-
-			return result
+		"""Outside transaction() the statement runs on its own pooled connection and is committed;
+		inside it, it joins the thread's transaction and is committed with it (or now, if commit=True).
+
+		``rows`` picks the row type of fetch="one"/"all": dict, plain tuple or namedtuple."""
+		return self._run(lambda conn, cur: cur.execute(query, params), fetch, rows, commit)
+
+	def prepare(self, name: str, query: str):
+		"""Registers a named query, PREPAREd lazily once per pooled connection and run by execute_prepared().
+
+		The query uses positional ``%s`` placeholders like execute()."""
+		if not _QUERY_NAME_RE.match(name):
+			raise ValueError(f"Invalid prepared query name '{name}'")
+
+		self._queries[name] = to_numbered_query(query)
+
+	def execute_prepared(
+		self,
+		name: str,
+		params: Optional[Sequence[Any]] = None,
+		fetch: FetchMode = "none",
+		commit: bool = False,
+		rows: RowMode = "dict",
+	):
+		"""Same as execute() for a query registered with prepare(); only the parameters go over the wire."""
+		numbered_query, params_count = self._queries[name]
+		params = tuple(params or ())
+		if len(params) != params_count:
+			raise ValueError(f"Prepared query '{name}' takes {params_count} parameters, got {len(params)}")
+
+		def run(conn, cur):
+			if name not in conn.prepared:
+				cur.execute(f"PREPARE {name} AS {numbered_query}")
+				conn.prepared.add(name)
+			cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * params_count)})" if params_count else f"EXECUTE {name}",
+						params)
+
+		return self._run(run, fetch, rows, commit)
+
+	def iterate(
+		self,
+		query: str,
+		params: Optional[Union[Sequence[Any], dict]] = None,
+		rows: RowMode = "dict",
+		itersize: int = 2000,
+	) -> Iterator:
+		"""Streams the rows of a query through a server-side (named) cursor, ``itersize`` rows per round trip.
+
+		The pooled connection stays checked out until the iterator is exhausted or closed."""
+		with self.transaction():
+			cursor_name = f"pdb_iter_{uuid.uuid4().hex}"
+			with self.conn.cursor(name=cursor_name, cursor_factory=ROW_CURSORS[rows],
+								  withhold=self._autocommit) as cur:
+				cur.itersize = itersize
+				cur.execute(query, params)
+				yield from cur
 
 	@contextmanager
 	def transaction(self):
-		"""Context manager for DB transactions, commit on success, rollback on error"""
-		if self._autocommit:
+		"""Context manager for DB transactions, commit on success, rollback on error.
+
+		Checks a connection out of the pool for the current thread; nested calls join the outer transaction."""
+		if getattr(self._local, "conn", None) is not None:
 			yield self
 			return
+
+		conn = self._checkout()
+		self._local.conn = conn
+		broken = False
 		try:
 			yield self
-			self.conn.commit()
-		except Exception:
-			self.conn.rollback()
+			if not self._autocommit:
+				conn.commit()
+		except CONNECTION_ERRORS:
+			broken = True
 			raise
-
-	def init_schema(self, sql_file_path: Optional[str] = None):
-		"""Apply SQL script to initialize schema (if passed and exists)."""
-		if not sql_file_path:
-			module_dir = os.path.dirname(os.path.abspath(__file__))
-			sql_file_path = os.path.join(module_dir, "init_scheme_src.sql")
-
-		if not os.path.exists(sql_file_path):
-			return
-
-		with open(sql_file_path, "r", encoding="utf-8") as f:
-			sql_src = f.read()
-
-		if not sql_src.strip():
-			return
-
-		with self.cursor() as cur:
-			cur.execute(sql_src)
+		except Exception:
 			if not self._autocommit:
-				self.conn.commit()
+				try:
+					conn.rollback()
+				except CONNECTION_ERRORS:
+					broken = True
+			raise
+		finally:
+			self._local.conn = None
+			self._checkin(conn, broken=broken)
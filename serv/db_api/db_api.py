@@ -1,250 +1,168 @@
 from datetime import datetime
 from pathlib import Path
 
-import os
+import heapq
 import logging
 import uuid
 
-from libs.pycrypter import Crypter, gen_key
-from libs.pystorage import *
-
-from libs.encrypted_storage_be_addon import EncryptedStorageBackend
+from .embedded_store import EmbeddedStore
+from .keys import get_key_manager
 
 
 class MainAppDatabaseAPI:
     KEYS_PATH = str(Path(__file__).resolve().parent.parent.parent) + "/data/keys"
 
     KEYS_TO_MAKE = [
-        "crypt_messages_key.bin"
+        "crypt_messages_key.bin",
+        "crypt_storage_key.bin"
     ]
 
+    # indexes: column -> unique
     TABLES = [
-        {"name": "accounts_table", "schema": {"account_id": int, "username": str, "password_hash": str,
-                                              "verify_token": str}},
-        {"name": "messages_table", "schema": {"message_id": int, "chat_uuid": str, "sender": str, "percipient": str,
-                                              "payload": bytes, "pds": tuple[bool, bool], "created_at": str}}
+        {"name": "users_table", "primary_key": "user_id", "indexes": {"username": True}},
+        {"name": "tokens_table", "primary_key": "t_id", "indexes": {"token": True}},
+        {"name": "chats_table", "primary_key": "chat_id", "indexes": {"owner": False}},
+        {"name": "messages_table", "primary_key": "message_id", "indexes": {"chat_id": False}}
     ]
 
     def __init__(self, storage_path: str):
-        self.storage = Storage(
-            storage_name="MAS",
-            storage_path=str(storage_path),
-            backend=EncryptedStorageBackend
-        )
+        self._key_manager = get_key_manager(self.KEYS_PATH)
+        self._key_manager.make_keys(self.KEYS_TO_MAKE)
+        self._messages_crypter = self._key_manager.crypter("crypt_messages_key.bin")
+
+        self.storage = EmbeddedStore(path=str(storage_path) + "/MAS",
+                                     key=self._key_manager.crypter("crypt_storage_key.bin"))
 
-        self._make_keys()
         self._make_tables()
+        self.storage.open()
 
         logging.info("Storage 'MAS' initialized")
 
-    def _make_keys(self):
-        for key_ in self.KEYS_TO_MAKE:
-            key_path = self.KEYS_PATH + f"/{key_}"
-            if not os.path.exists(key_path):
-                with open(file=key_path, mode="wb") as key_file:
-                    key_file.write(gen_key(len_=512))
-            else:
-                with open(file=key_path, mode="rb") as key_file:
-                    key_data = key_file.read()
-                    if len(key_data) < 32:
-                        logging.warning(f"Key file {key_} is too short, regenerating...")
-                        with open(file=key_path, mode="wb") as key_file:
-                            key_file.write(gen_key(len_=512))
-
     def _make_tables(self):
         for table_ in self.TABLES:
-            self.storage.write(table_["name"], Table(data=[], schema=table_["schema"]), True)
+            self.storage.create_table(table_["name"], table_["primary_key"], table_["indexes"])
+
+    def close(self):
+        self.storage.close()
+
+    def _get_user(self, username: str) -> dict | None:
+        return self.storage.table("users_table").find_one("username", str(username))
 
     def check_user_is_exist(self, username: str):
-        table_ = self.storage.read(key="users_table", item_type=Table)
-        if table_ is None:
-            return False
-        for r in table_.dataframe.to_dict("records"):
-            if r["username"] == str(username): return True
-        return False
-
-    @staticmethod
-    def _get_record_id(table_: Table, id_key: str):
-        if table_ is None:
-            return 0
-        try:
-            last_record = table_.dataframe.to_dict("records")[-1]
-            if str(id_key) not in last_record:
-                last_record_id = 0
-            else:
-                last_record_id = last_record[str(id_key)] + 1
-
-        except IndexError:
-            return 0
-
-        return int(last_record_id)
+        return self._get_user(username) is not None
 
     def make_user_r(self, username: str, password_hash: str):
-        table_ = self.storage.read(key="users_table", item_type=Table)
-        if table_ is None:
-            table_ = Table(data=[], schema=self.TABLES[0]["schema"])
-
-        new_record = TableRecord(record={
-            "user_id": int(self._get_record_id(table_, id_key="user_id")),
+        self.storage.insert("users_table", {
             "username": str(username),
             "password_hash": str(password_hash),
             "created_at": str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         })
 
-        table_.add_record(record=new_record)
-        self.storage.write(key="users_table", item=table_)
-
     def check_user_passwd(self, username: str, password_hash: str):
-        table_ = self.storage.read(key="users_table", item_type=Table)
-        if table_ is None:
-            return False
-        for r in table_.dataframe.to_dict("records"):
-            if r["username"] == str(username) and r["password_hash"] == str(password_hash): return True
-
-        return False
+        user = self._get_user(username)
+        return user is not None and user["password_hash"] == str(password_hash)
 
     def generate_token(self, username: str, password_hash: str):
         if not self.check_user_passwd(username, password_hash):
             return None
 
-        table_ = self.storage.read(key="tokens_table", item_type=Table)
-        if table_ is None:
-            table_ = Table(data=[], schema=self.TABLES[1]["schema"])
-
         token = str(uuid.uuid4())
-        new_record = TableRecord(record={
-            "t_id": int(self._get_record_id(table_, id_key="t_id")),
+        self.storage.insert("tokens_table", {
             "token": token,
             "username": str(username),
             "created_at": str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         })
 
-        table_.add_record(record=new_record)
-        self.storage.write(key="tokens_table", item=table_)
-
         return token
 
     def validate_token(self, token: str):
-        table_ = self.storage.read(key="tokens_table", item_type=Table)
-        if table_ is None:
-            return None
-        for r in table_.dataframe.to_dict("records"):
-            if r["token"] == str(token):
-                return r["username"]
-
-        return None
+        record = self.storage.table("tokens_table").find_one("token", str(token))
+        return record["username"] if record is not None else None
 
     def change_password(self, username: str, new_password_hash: str):
-        table_ = self.storage.read(key="users_table", item_type=Table)
-
-        mask = table_.dataframe["username"] == str(username)
-        if len(table_.dataframe[mask]) == 0:
+        user = self._get_user(username)
+        if user is None:
             return False
 
-        table_.dataframe.loc[mask, "password_hash"] = str(new_password_hash)
-        self.storage.write(key="users_table", item=table_)
-        return True
+        return self.storage.update("users_table", user["user_id"], password_hash=str(new_password_hash))
 
-    def get_messages_own_user(self, username: str):
+    def get_messages_own_user(self, username: str, last_num: int = -1, limit: int | None = None):
+        """Up to ``limit`` (all when None) messages of the user's chats with id greater than last_num, oldest first."""
         username = str(username)
 
-        table_ = self.storage.read(key="messages_table", item_type=Table)
-        chat_table = self.storage.read(key="chats_table", item_type=Table)
+        messages_table = self.storage.table("messages_table")
+
+        # Participants are a list per chat, so chats are still scanned; messages come from the chat_id index
+        chat_dict = {}
+        for r in self.storage.table("chats_table"):
+            if username in r["participants"] or r["owner"] == username:
+                chat_dict[r["chat_id"]] = r["name"]
+
+        # Each chat's messages are indexed in id order, merging them yields the page without sorting the inbox
+        chat_records = heapq.merge(
+            *((rcd for rcd in messages_table.find("chat_id", chat_id) if rcd["message_id"] > last_num)
+              for chat_id in chat_dict),
+            key=lambda rcd: rcd["message_id"])
+
+        user_records = []
+        for rcd in chat_records:
+            if limit is not None and len(user_records) >= limit:
+                break
 
-        if table_ is None or chat_table is None:
-            return []
+            if not rcd["payload_bytes"] or len(rcd["payload_bytes"]) == 0:
+                logging.warning(f"Skipping message ID {rcd['message_id']}: empty payload bytes")
+                continue
 
-        records = table_.dataframe.to_dict("records")
+            user_records.append(rcd)
 
-        crypter_l1 = Crypter(key=open(file=f"{self.KEYS_PATH}/crypt_messages_key.bin", mode="rb").read())
+        # One batch call with the cached crypter instead of a key file read and a decrypt call per message
+        payloads = self._messages_crypter.decrypt_many([rcd["payload_bytes"] for rcd in user_records],
+                                                       skip_invalid=True)
 
         user_messages = []
-        chat_dict = {}
-        for r in chat_table.dataframe.to_dict("records"):
-            if username in r["participants"] or r["owner"] == username:
-                chat_dict[r["chat_id"]] = r["name"]
+        for rcd, payload_decrypted in zip(user_records, payloads):
+            if payload_decrypted is None:
+                logging.error(f"Failed to decrypt message ID {rcd['message_id']}")
+                continue
+
+            if len(payload_decrypted) == 0:
+                logging.warning(
+                    f"Skipping invalid message ID {rcd['message_id']}: " + \
+                    f"payload is empty")
+                continue
 
-        for rcd in records:
-            if rcd["chat_id"] in chat_dict:
-                try:
-                    if not rcd["payload_bytes"] or len(rcd["payload_bytes"]) == 0:
-                        logging.warning(f"Skipping message ID {rcd['message_id']}: empty payload bytes")
-                        continue
-
-                    payload_decrypted_l1 = crypter_l1.decrypt(rcd["payload_bytes"])
-                    if len(payload_decrypted_l1) == 0:
-                        logging.warning(
-                            f"Skipping invalid message ID {rcd['message_id']}: " + \
-                            f"payload is empty")
-                        continue
-
-                    payload_decrypted = payload_decrypted_l1
-                    user_messages.append(
-                        (rcd["message_id"], payload_decrypted, rcd["sender"], rcd["chat_id"],
-                         chat_dict[rcd["chat_id"]], rcd["created_at"]))
-
-                except Exception as e:
-                    logging.error(f"Failed to decrypt message ID {rcd['message_id']}: {str(e)}")
-                    continue
+            user_messages.append(
+                (rcd["message_id"], payload_decrypted, rcd["sender"], rcd["chat_id"],
+                 chat_dict[rcd["chat_id"]], rcd["created_at"]))
 
         return user_messages
 
     def make_message_r(self, username: str, payload: str, chat_id: int):
-        table_ = self.storage.read(key="messages_table", item_type=Table)
-        chat_table = self.storage.read(key="chats_table", item_type=Table)
-
-        chat = None
-        for r in chat_table.dataframe.to_dict("records"):
-            if r["chat_id"] == int(chat_id):
-                chat = r
-                break
-
+        chat = self.storage.table("chats_table").get(int(chat_id))
         if not chat or (username not in chat["participants"] and username != chat["owner"]):
             raise ValueError("Invalid chat_id or user not in chat")
 
-        crypter_l1 = Crypter(key=open(file=f"{self.KEYS_PATH}/crypt_messages_key.bin", mode="rb").read())
-
         if not payload or len(payload.strip()) == 0:
             raise ValueError("Message payload cannot be empty")
 
         payload_bytes = payload.encode()
-        payload_crypted_l1 = crypter_l1.encrypt(payload_bytes)
+        payload_crypted_l1 = self._messages_crypter.encrypt(payload_bytes)
         payload_crypted = payload_crypted_l1
 
-        new_record = {
-            "message_id": int(self._get_record_id(table_, id_key="message_id")),
+        self.storage.insert("messages_table", {
             "sender": str(username),
             "payload_bytes": payload_crypted,
             "chat_id": int(chat_id),
             "created_at": str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        }
-
-        table_.add_record(record=TableRecord(record=new_record))
-        self.storage.write(key="messages_table", item=table_)
+        })
 
     def delete_message(self, message_id: int, username: str):
-        table_ = self.storage.read(key="messages_table", item_type=Table)
-        records = table_.dataframe.to_dict("records")
-        for i, r in enumerate(records):
-            if r["message_id"] == int(message_id) and r["sender"] == str(username):
-                table_.remove_record(i)
-
-                self.storage.write(key="messages_table", item=table_)
-                return True
+        record = self.storage.table("messages_table").get(int(message_id))
+        if record is None or record["sender"] != str(username):
+            return False
 
-        return False
+        return self.storage.delete("messages_table", int(message_id))
 
     def _delete_messages_by_chat_id(self, chat_id: int):
-        table_ = self.storage.read(key="messages_table", item_type=Table)
-        if table_ is None:
-            return
-        records = table_.dataframe.to_dict("records")
-        indices_to_remove = []
-        for i, r in enumerate(records):
-            if r["chat_id"] == int(chat_id):
-                indices_to_remove.append(i)
-
-        for i in sorted(indices_to_remove, reverse=True):
-            table_.remove_record(i)
-
-        self.storage.write(key="messages_table", item=table_)
+        for r in self.storage.table("messages_table").find("chat_id", int(chat_id)):
+            self.storage.delete("messages_table", r["message_id"])
@@ -0,0 +1,230 @@
+import itertools
+import threading
+
+from typing import Any, Dict, Iterable, Iterator, List
+
+from libs.pycrypter import CryptedLog, Crypter
+
+
+# Log records are (op, table, primary key, record or changes)
+OP_INSERT = "I"
+OP_UPDATE = "U"
+OP_DELETE = "D"
+
+
+class StoreError(Exception):
+    pass
+
+
+class DuplicateKeyError(StoreError):
+    def __init__(self, table: str, column: str, value: Any):
+        super().__init__(f"Duplicate value {value!r} for unique column '{table}.{column}'")
+
+
+class StoreTable:
+    """Records of one table keyed by primary key, with hash indexes on selected columns.
+
+    Unique indexes map value -> primary key, non-unique ones value -> primary keys in insert order.
+    Returned records are the stored dicts: change them through EmbeddedStore.update(), not in place."""
+
+    def __init__(self, name: str, primary_key: str, indexes: Dict[str, bool] | None = None):
+        self.name = name
+        self.primary_key = primary_key
+
+        self._records: Dict[Any, dict] = {}
+        self._indexes: Dict[str, dict] = {column: {} for column in (indexes or {})}
+        self._unique = {column for column, unique in (indexes or {}).items() if unique}
+
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(list(self._records.values()))
+
+    def _check_unique(self, record: dict, key: Any):
+        for column in self._unique:
+            if column in record:
+                owner = self._indexes[column].get(record[column], key)
+                if owner != key:
+                    raise DuplicateKeyError(self.name, column, record[column])
+
+    def _index(self, record: dict, key: Any):
+        for column, index in self._indexes.items():
+            if column not in record:
+                continue
+            if column in self._unique:
+                index[record[column]] = key
+            else:
+                index.setdefault(record[column], {})[key] = None
+
+    def _unindex(self, record: dict, key: Any):
+        for column, index in self._indexes.items():
+            if column not in record:
+                continue
+            if column in self._unique:
+                index.pop(record[column], None)
+            else:
+                keys = index.get(record[column])
+                if keys is not None:
+                    keys.pop(key, None)
+                    if not keys:
+                        del index[record[column]]
+
+    def next_id(self) -> int:
+        return self._next_id
+
+    def dump(self) -> Iterator[object]:
+        """Snapshot records of the table: ``(name, next_id, record count)``, then the records."""
+        yield self.name, self._next_id, len(self._records)
+        yield from self._records.values()
+
+    def load(self, next_id: int, records: Iterable[dict]):
+        for record in records:
+            self.apply_insert(record[self.primary_key], record)
+        self._next_id = max(self._next_id, next_id)
+
+    def apply_insert(self, key: Any, record: dict):
+        if key in self._records:
+            raise DuplicateKeyError(self.name, self.primary_key, key)
+        self._check_unique(record, key)
+
+        self._records[key] = record
+        self._index(record, key)
+        if isinstance(key, int) and key >= self._next_id:
+            self._next_id = key + 1
+
+    def apply_update(self, key: Any, changes: dict):
+        record = self._records[key]
+        updated = {**record, **changes}
+        self._check_unique(updated, key)
+
+        self._unindex(record, key)
+        self._records[key] = updated
+        self._index(updated, key)
+
+    def apply_delete(self, key: Any):
+        record = self._records.pop(key)
+        self._unindex(record, key)
+
+    def get(self, key: Any) -> dict | None:
+        return self._records.get(key)
+
+    def find(self, column: str, value: Any) -> List[dict]:
+        index = self._indexes[column]
+        if column in self._unique:
+            key = index.get(value)
+            return [self._records[key]] if key is not None else []
+
+        return [self._records[key] for key in index.get(value, ())]
+
+    def find_one(self, column: str, value: Any) -> dict | None:
+        records = self.find(column, value)
+        return records[0] if records else None
+
+
+class EmbeddedStore:
+    """Single-node store for dev deployments: tables live in memory with hash indexes, every change is
+    appended to an encrypted CryptedLog, which is replayed on open and compacted into a snapshot every
+    ``compact_every`` changes. Lookups by an indexed column are O(1) and a write costs one log record,
+    independent of the table size."""
+
+    def __init__(self, path: str | None = None, key: str | bytes | Crypter | None = None, fsync: bool = False,
+                 compact_every: int = 4096):
+        if path is not None and key is None:
+            raise StoreError("A persistent EmbeddedStore requires a key")
+
+        self.path = path
+        self._log = CryptedLog(filename=path, key=key, fsync=fsync, compact_every=compact_every) \
+            if path is not None else None
+
+        self._tables: Dict[str, StoreTable] = {}
+        self._lock = threading.RLock()
+
+    def create_table(self, name: str, primary_key: str, indexes: Dict[str, bool] | None = None) -> StoreTable:
+        """Declares a table; ``indexes`` maps column -> unique. Call for every table before open()."""
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = StoreTable(name=name, primary_key=primary_key, indexes=indexes)
+            return self._tables[name]
+
+    def table(self, name: str) -> StoreTable:
+        return self._tables[name]
+
+    def open(self):
+        """Loads the last snapshot, replays the log written after it and opens the log for appending."""
+        if self._log is None:
+            return
+
+        with self._lock:
+            snapshot, entries = self._log.recover()
+            for name, next_id, count in snapshot:
+                self._tables[name].load(next_id, itertools.islice(snapshot, count))
+            for entry in entries:
+                self._apply(*entry)
+
+    def _apply(self, op: str, table_name: str, key: Any, data: dict | None):
+        table = self._tables[table_name]
+        if op == OP_INSERT:
+            table.apply_insert(key, data)
+        elif op == OP_UPDATE:
+            table.apply_update(key, data)
+        elif op == OP_DELETE:
+            table.apply_delete(key)
+        else:
+            raise StoreError(f"Unknown log operation '{op}'")
+
+    def _append(self, *entry):
+        if self._log is None:
+            return
+
+        self._log.append(entry)
+        if self._log.needs_compaction:
+            self.compact()
+
+    def compact(self):
+        """Writes all tables as the log's snapshot, so recovery no longer replays the changes before it."""
+        if self._log is None:
+            return
+
+        with self._lock:
+            self._log.compact(itertools.chain.from_iterable(table.dump() for table in self._tables.values()))
+
+    def insert(self, table_name: str, record: dict) -> Any:
+        """Adds a record; a missing primary key is taken from the table's id sequence. Returns the key."""
+        with self._lock:
+            table = self._tables[table_name]
+            record = dict(record)
+            key = record.setdefault(table.primary_key, table.next_id())
+
+            table.apply_insert(key, record)
+            self._append(OP_INSERT, table_name, key, record)
+            return key
+
+    def update(self, table_name: str, key: Any, **changes) -> bool:
+        with self._lock:
+            table = self._tables[table_name]
+            if table.primary_key in changes:
+                raise StoreError(f"Primary key '{table_name}.{table.primary_key}' can't be updated")
+            if table.get(key) is None:
+                return False
+
+            table.apply_update(key, changes)
+            self._append(OP_UPDATE, table_name, key, changes)
+            return True
+
+    def delete(self, table_name: str, key: Any) -> bool:
+        with self._lock:
+            table = self._tables[table_name]
+            if table.get(key) is None:
+                return False
+
+            table.apply_delete(key)
+            self._append(OP_DELETE, table_name, key, None)
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import logging
+import os
+import threading
+
+from libs.pycrypter import Crypter, gen_key
+
+
+KEYS_PATH = str(Path(__file__).resolve().parent.parent.parent) + "/data/keys"
+
+
+class KeyManager:
+    """Owns the at-rest key files of a keys directory: creates missing ones and reads each key from disk
+    once, handing out one cached Crypter (key already SHA-256 formatted) per key file."""
+
+    KEY_LEN = 512
+    MIN_KEY_LEN = 32
+
+    def __init__(self, keys_path: str = KEYS_PATH):
+        self.keys_path = keys_path
+        self._crypters: dict[str, Crypter] = {}
+        self._lock = threading.Lock()
+
+    def make_keys(self, key_names: list[str]):
+        os.makedirs(self.keys_path, exist_ok=True)
+
+        for key_ in key_names:
+            key_path = self.keys_path + f"/{key_}"
+            if not os.path.exists(key_path):
+                with open(file=key_path, mode="wb") as key_file:
+                    key_file.write(gen_key(len_=self.KEY_LEN))
+            else:
+                with open(file=key_path, mode="rb") as key_file:
+                    key_data = key_file.read()
+                    if len(key_data) < self.MIN_KEY_LEN:
+                        logging.warning(f"Key file {key_} is too short, regenerating...")
+                        with open(file=key_path, mode="wb") as key_file:
+                            key_file.write(gen_key(len_=self.KEY_LEN))
+
+    def crypter(self, key_name: str) -> Crypter:
+        crypter = self._crypters.get(key_name)
+        if crypter is not None:
+            return crypter
+
+        with self._lock:
+            if key_name not in self._crypters:
+                with open(file=f"{self.keys_path}/{key_name}", mode="rb") as key_file:
+                    self._crypters[key_name] = Crypter(key=key_file.read())
+
+            return self._crypters[key_name]
+
+
+_key_managers: dict[str, KeyManager] = {}
+_key_managers_lock = threading.Lock()
+
+
+def get_key_manager(keys_path: str = KEYS_PATH) -> KeyManager:
+    """Process-wide KeyManager of ``keys_path``, so every API instance shares the loaded keys."""
+    with _key_managers_lock:
+        if keys_path not in _key_managers:
+            _key_managers[keys_path] = KeyManager(keys_path)
+
+        return _key_managers[keys_path]
@@ -1,54 +1,169 @@
-from configparser import ConfigParser
-from pathlib import Path
-
-import logging
-import os
-
-from libs.pycrypter import gen_key
-
-from .databaser import PDB
-
-
-def build_conf_of_pdb(app_conf: ConfigParser):
-    db_conf = app_conf["db"]
-
-    user = db_conf["role"]
-    user_password = db_conf["role_passwd"]
-    host = db_conf["db_host"]
-    port = db_conf["db_port"]
-    database_name = db_conf["db_name"]
-
-    return None, host, port, database_name, user, user_password, None, False
-
-
-class MainAppDatabaseAPI:
-    KEYS_PATH = str(Path(__file__).resolve().parent.parent.parent) + "/data/keys"
-
-    KEYS_TO_MAKE = [
-        "crypt_accounts_key.bin",
-        "crypt_messages_key.bin"
-    ]
-
-    def __init__(self, app_conf: ConfigParser):
-        self.db = PDB(*build_conf_of_pdb(app_conf=app_conf))
-
-        self.db.init_schema()
-
-        self._make_keys()
-
-        logging.info(f"Database '{build_conf_of_pdb(app_conf=app_conf)[3]}' initialized successfully by role " + \
-                     build_conf_of_pdb(app_conf=app_conf)[4])
-
-    def _make_keys(self):
-        for key_ in self.KEYS_TO_MAKE:
-            key_path = self.KEYS_PATH + f"/{key_}"
-            if not os.path.exists(key_path):
-                with open(file=key_path, mode="wb") as key_file:
-                    key_file.write(gen_key(len_=512))
-            else:
-                with open(file=key_path, mode="rb") as key_file:
-                    key_data = key_file.read()
-                    if len(key_data) < 32:
-                        logging.warning(f"Key file {key_} is too short, regenerating...")
-                        with open(file=key_path, mode="wb") as key_file:
-                            key_file.write(gen_key(len_=512))
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import os
+
+from libs.pycrypter import Crypter
+
+from .databaser import PDB
+from .keys import KEYS_PATH, get_key_manager
+from .migrator import migrate
+from .write_batcher import WriteBatcher, build_conf_of_write_batcher
+
+
+def build_conf_of_pdb(app_conf: ConfigParser):
+    db_conf = app_conf["db"]
+
+    user = db_conf["role"]
+    user_password = db_conf["role_passwd"]
+    host = db_conf["db_host"]
+    port = db_conf["db_port"]
+    database_name = db_conf["db_name"]
+
+    pool_min_size = db_conf.getint("pool_min_size", fallback=2)
+    pool_max_size = db_conf.getint("pool_max_size", fallback=16)
+    pool_timeout = db_conf.getfloat("pool_timeout", fallback=5.0)
+    health_check_interval = db_conf.getfloat("health_check_interval", fallback=30.0)
+
+    return None, host, port, database_name, user, user_password, None, False, \
+        pool_min_size, pool_max_size, pool_timeout, health_check_interval
+
+
+CREATE_ACCOUNT_SQL = "INSERT INTO accounts (username, password_hash) VALUES (%s, %s) " \
+                     "ON CONFLICT (username) DO NOTHING RETURNING id"
+GET_PASSWORD_HASH_SQL = "SELECT password_hash FROM accounts WHERE username = %s"
+SET_VERIFY_TOKEN_SQL = "UPDATE accounts SET verify_token = %s WHERE username = %s"
+GET_VERIFY_TOKEN_SQL = "SELECT verify_token FROM accounts WHERE username = %s"
+
+ADD_MESSAGE_SQL = "INSERT INTO messages (chat_uuid, sender, percipient, payload) VALUES (%s, %s, %s, %s) RETURNING id"
+# WriteBatcher rows are (ordinal, *row): ids are drawn per row next to its ordinal, so each id is matched to its
+# row without relying on the order of RETURNING
+ADD_MESSAGES_BATCH_SQL = "WITH batch (ordinal, chat_uuid, sender, percipient, payload) AS (VALUES %s), " \
+                         "ids AS (SELECT *, nextval(pg_get_serial_sequence('messages', 'id')) AS id FROM batch), " \
+                         "inserted AS (INSERT INTO messages (id, chat_uuid, sender, percipient, payload) " \
+                         "SELECT id, chat_uuid, sender, percipient, payload FROM ids RETURNING id) " \
+                         "SELECT ids.ordinal, inserted.id FROM inserted JOIN ids USING (id)"
+SET_PDS_SQL = "UPDATE messages SET pds_sender = pds_sender OR sender = %s, " \
+              "pds_percipient = pds_percipient OR percipient = %s " \
+              "WHERE id = ANY(%s) AND (sender = %s OR percipient = %s)"
+DELETE_PDS_SQL = "DELETE FROM messages WHERE id = ANY(%s) AND pds_sender AND pds_percipient"
+
+# Keyset pagination: id > last seen id, LIMIT NULL reads to the end
+GET_MESSAGES_SQL = "SELECT id, chat_uuid, sender, payload, created_at FROM messages " \
+                   "WHERE percipient = %s AND id > %s ORDER BY id LIMIT %s"
+GET_CHAT_MESSAGES_SQL = "SELECT id, chat_uuid, sender, payload, created_at FROM messages " \
+                        "WHERE percipient = %s AND id > %s AND chat_uuid = %s ORDER BY id LIMIT %s"
+
+# Hot queries, run as server-side prepared statements
+PREPARED_QUERIES = {
+    "get_password_hash": GET_PASSWORD_HASH_SQL,
+    "add_message": ADD_MESSAGE_SQL,
+    "get_messages": GET_MESSAGES_SQL,
+    "get_chat_messages": GET_CHAT_MESSAGES_SQL
+}
+
+
+class MainAppDatabaseAPI:
+    KEYS_PATH = KEYS_PATH
+
+    KEYS_TO_MAKE = [
+        "crypt_accounts_key.bin",
+        "crypt_messages_key.bin"
+    ]
+
+    def __init__(self, app_conf: ConfigParser):
+        self.db = PDB(*build_conf_of_pdb(app_conf=app_conf))
+
+        migrate(self.db)
+
+        for name, query in PREPARED_QUERIES.items():
+            self.db.prepare(name, query)
+
+        # SEND_MSG from concurrent connections shares one INSERT and one commit per flush window
+        write_batcher_conf = build_conf_of_write_batcher(app_conf=app_conf)
+        self._messages_batcher = WriteBatcher(self.db, ADD_MESSAGES_BATCH_SQL, returning=True, **write_batcher_conf) \
+            if write_batcher_conf["max_batch_size"] > 1 else None
+
+        self._messages_crypter = self._load_messages_crypter()
+
+        # Batch decryption fans out over a per-process thread pool; crypt_workers <= 0 decrypts inline
+        self._crypt_workers = app_conf.getint("db", "crypt_workers", fallback=0)
+        self._crypt_pool = None
+        self._crypt_pool_pid = None
+
+        logging.info(f"Database '{build_conf_of_pdb(app_conf=app_conf)[3]}' initialized successfully by role " + \
+                     build_conf_of_pdb(app_conf=app_conf)[4])
+
+    def close(self):
+        if self._messages_batcher is not None:
+            self._messages_batcher.stop()
+        if self._crypt_pool is not None:
+            self._crypt_pool.shutdown(wait=False)
+
+        self.db.close()
+
+    def _load_messages_crypter(self) -> Crypter:
+        key_manager = get_key_manager(self.KEYS_PATH)
+        key_manager.make_keys(self.KEYS_TO_MAKE)
+
+        return key_manager.crypter("crypt_messages_key.bin")
+
+    def _crypt_executor(self) -> ThreadPoolExecutor | None:
+        if self._crypt_workers <= 0:
+            return None
+
+        # Created lazily per process: a pool inherited through fork has no live threads
+        if self._crypt_pool_pid != os.getpid():
+            self._crypt_pool_pid = os.getpid()
+            self._crypt_pool = ThreadPoolExecutor(max_workers=self._crypt_workers, thread_name_prefix="crypt")
+
+        return self._crypt_pool
+
+    def _decode_messages(self, rows: list[dict]) -> list[dict]:
+        payloads = self._messages_crypter.decrypt_many([row["payload"] for row in rows],
+                                                       executor=self._crypt_executor())
+
+        for row, payload in zip(rows, payloads):
+            row["payload"] = payload
+            row["created_at"] = row["created_at"].isoformat()
+
+        return rows
+
+    def create_account(self, username: str, password_hash: str) -> bool:
+        account_id = self.db.execute(CREATE_ACCOUNT_SQL, (username, password_hash), fetch="val", commit=True)
+
+        return account_id is not None
+
+    def get_password_hash(self, username: str) -> str | None:
+        return self.db.execute_prepared("get_password_hash", (username,), fetch="val")
+
+    def set_verify_token(self, username: str, token: str):
+        self.db.execute(SET_VERIFY_TOKEN_SQL, (token, username))
+
+    def get_verify_token(self, username: str) -> str | None:
+        return self.db.execute(GET_VERIFY_TOKEN_SQL, (username,), fetch="val")
+
+    def add_message(self, chat_uuid: str, sender: str, percipient: str, payload: bytes) -> int:
+        row = (chat_uuid, sender, percipient, self._messages_crypter.encrypt(payload))
+        if self._messages_batcher is not None:
+            return self._messages_batcher.submit(row).result()
+
+        return self.db.execute_prepared("add_message", row, fetch="val", commit=True)
+
+    def set_pds(self, username: str, message_ids: list[int]):
+        """Marks the user's consent to delete the messages and drops the ones both sides agreed on."""
+        with self.db.transaction():
+            self.db.execute(SET_PDS_SQL, (username, username, message_ids, username, username))
+            self.db.execute(DELETE_PDS_SQL, (message_ids,))
+
+    def get_messages(self, username: str, last_num: int, chat_uuid: str | None = None,
+                     limit: int | None = None) -> list[dict]:
+        """Up to ``limit`` messages addressed to the user with id greater than last_num, oldest first,
+        payloads decrypted."""
+        if chat_uuid is None:
+            rows = self.db.execute_prepared("get_messages", (username, last_num, limit), fetch="all")
+        else:
+            rows = self.db.execute_prepared("get_chat_messages", (username, last_num, chat_uuid, limit), fetch="all")
+
+        return self._decode_messages(rows)
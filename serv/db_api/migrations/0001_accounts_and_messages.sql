@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS accounts (
+    id              BIGSERIAL PRIMARY KEY,
+    username        TEXT NOT NULL UNIQUE,
+    password_hash   TEXT NOT NULL,
+    verify_token    TEXT
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id              BIGSERIAL PRIMARY KEY,
+    chat_uuid       TEXT NOT NULL,
+    sender          TEXT NOT NULL,
+    percipient      TEXT NOT NULL,
+    payload         BYTEA NOT NULL,
+    pds_sender      BOOLEAN NOT NULL DEFAULT FALSE,
+    pds_percipient  BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
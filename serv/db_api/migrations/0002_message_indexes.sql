@@ -0,0 +1,5 @@
+-- READ_ALL_MESSAGES: WHERE percipient = ? AND id > ? ORDER BY id
+CREATE INDEX IF NOT EXISTS messages_percipient_id_idx ON messages (percipient, id);
+
+-- READ_MESSAGES_OF_CHAT: WHERE percipient = ? AND id > ? AND chat_uuid = ? ORDER BY id
+CREATE INDEX IF NOT EXISTS messages_percipient_chat_uuid_id_idx ON messages (percipient, chat_uuid, id);
@@ -0,0 +1,76 @@
+import logging
+import os
+import re
+
+from pathlib import Path
+
+from .databaser import PDB
+
+
+MIGRATIONS_DIR = str(Path(__file__).resolve().parent) + "/migrations"
+
+CRYPT_DB_PROTOCOL_VERSION_FILE = str(Path(__file__).resolve().parent.parent.parent) + \
+                                 "/data/vers/crypt_db_protocol_version"
+
+# Serializes migrations of prefork workers and servers starting against the same database
+MIGRATION_LOCK_ID = 0x53570001
+
+_MIGRATION_FILE_RE = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+CREATE_SCHEMA_VERSION_SQL = "CREATE TABLE IF NOT EXISTS schema_version (" \
+                            "version INT PRIMARY KEY, name TEXT NOT NULL, " \
+                            "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+GET_SCHEMA_VERSION_SQL = "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+SET_SCHEMA_VERSION_SQL = "INSERT INTO schema_version (version, name) VALUES (%s, %s)"
+
+
+def load_db_protocol_version() -> int:
+    with open(file=CRYPT_DB_PROTOCOL_VERSION_FILE, mode="r", encoding="UTF-8") as proto_vers_file_db:
+        return int(proto_vers_file_db.readline().strip())
+
+
+def load_migrations(migrations_dir: str = MIGRATIONS_DIR) -> list[tuple[int, str, str]]:
+    """``NNNN_name.sql`` files as (version, name, sql), ordered by version."""
+    migrations = []
+    for file_name in sorted(os.listdir(migrations_dir)):
+        match = _MIGRATION_FILE_RE.match(file_name)
+        if match is None:
+            continue
+
+        with open(file=os.path.join(migrations_dir, file_name), mode="r", encoding="utf-8") as migration_file:
+            migrations.append((int(match.group(1)), match.group(2), migration_file.read()))
+
+    return migrations
+
+
+def _pending_migrations(current_version: int, target_version: int) -> list[tuple[int, str, str]]:
+    if current_version > target_version:
+        raise RuntimeError(f"Database schema version {current_version} is newer than " + \
+                           f"crypt_db_protocol_version {target_version}")
+
+    migrations = [m for m in load_migrations() if current_version < m[0] <= target_version]
+
+    available_version = migrations[-1][0] if migrations else current_version
+    if available_version != target_version:
+        raise RuntimeError(f"No migrations to bring the database schema to version {target_version} " + \
+                           f"(last available: {available_version})")
+
+    return migrations
+
+
+def migrate(db: PDB, target_version: int | None = None) -> int:
+    """Applies the pending migrations up to ``target_version`` (crypt_db_protocol_version by default)
+    in one transaction and returns the resulting schema version."""
+    target_version = load_db_protocol_version() if target_version is None else target_version
+
+    with db.transaction():
+        db.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,), fetch="val")
+        db.execute(CREATE_SCHEMA_VERSION_SQL)
+        current_version = db.execute(GET_SCHEMA_VERSION_SQL, fetch="val")
+
+        for version, name, sql in _pending_migrations(current_version, target_version):
+            logging.info(f"Applying database migration {version:04d}_{name}")
+            db.execute(sql)
+            db.execute(SET_SCHEMA_VERSION_SQL, (version, name))
+
+    return target_version
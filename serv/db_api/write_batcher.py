@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+from configparser import ConfigParser
+from typing import Any, Sequence
+
+import psycopg2.extras
+
+from .databaser import PDB
+
+
+def build_conf_of_write_batcher(app_conf: ConfigParser) -> dict:
+    return {
+        "flush_interval": app_conf.getfloat("db", "write_batch_interval", fallback=0.002),
+        "max_batch_size": app_conf.getint("db", "write_batch_size", fallback=256)
+    }
+
+
+class WriteBatcher:
+    """Groups single-row INSERTs from concurrent threads into one ``execute_values`` statement and one commit.
+
+    ``query`` takes the rows through ``VALUES %s``. With ``returning`` each row is passed as ``(ordinal, *row)``
+    and the query must return one ``(ordinal, value)`` row per input row: PostgreSQL doesn't promise that a
+    multi-row ``INSERT ... RETURNING`` keeps VALUES order, so values are matched to rows by ordinal.
+    ``submit()`` returns a Future resolved with that value (or None) once the batch holding the row is committed.
+    The first row of a batch waits at most ``flush_interval`` seconds for others to join it."""
+
+    def __init__(self, db: PDB, query: str, returning: bool = False, flush_interval: float = 0.002,
+                 max_batch_size: int = 256):
+        self.db = db
+        self.query = query
+        self.returning = returning
+
+        self.flush_interval = flush_interval
+        self.max_batch_size = max(1, max_batch_size)
+
+        self._pending: list[tuple[Sequence[Any], Future]] = []
+        self._cond = threading.Condition()
+        self._running = True
+
+        self._pid = None
+        self._thread = None
+
+    def _ensure_flusher(self):
+        # Started lazily so prefork workers each get their own flusher thread
+        if self._pid != os.getpid() or self._thread is None:
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._flush_loop, name="write-batcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, row: Sequence[Any]) -> Future:
+        future = Future()
+
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("WriteBatcher is stopped")
+
+            self._ensure_flusher()
+            self._pending.append((row, future))
+            self._cond.notify()
+
+        return future
+
+    def _take_batch(self) -> list[tuple[Sequence[Any], Future]]:
+        with self._cond:
+            while not self._pending and self._running:
+                self._cond.wait()
+
+            deadline = time.monotonic() + self.flush_interval
+            while self._running and len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            return batch
+
+    def _flush(self, batch: list[tuple[Sequence[Any], Future]]):
+        if self.returning:
+            rows = [(ordinal, *row) for ordinal, (row, _) in enumerate(batch)]
+        else:
+            rows = [row for row, _ in batch]
+
+        try:
+            with self.db.transaction():
+                with self.db.cursor() as cur:
+                    results = psycopg2.extras.execute_values(
+                        cur, self.query, rows, page_size=len(rows), fetch=self.returning)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        if not self.returning:
+            for _, future in batch:
+                future.set_result(None)
+            return
+
+        values = {ordinal: value for ordinal, value in results}
+        for ordinal, (_, future) in enumerate(batch):
+            if ordinal in values:
+                future.set_result(values[ordinal])
+            else:
+                future.set_exception(RuntimeError(f"Batched write returned no value for row {ordinal}"))
+
+    def _flush_loop(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+
+            try:
+                self._flush(batch)
+            except Exception:
+                logging.exception("Write batch flush failed")
+
+    def stop(self):
+        """Flushes the rows already submitted and stops the flusher thread."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+
+        if thread is not None:
+            thread.join()
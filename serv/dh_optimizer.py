@@ -1,23 +1,157 @@
 import threading
 import logging
+import os
+import struct
 
+from configparser import ConfigParser
+from pathlib import Path
 from typing import Optional
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
 
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import dh
 from cryptography.hazmat.backends import default_backend
 
+from .metrics import Counter
+
+
+DATA_DIR = str(Path(__file__).resolve().parent.parent) + "/data"
+
+DEFAULT_DH_PARAMS_FILE = DATA_DIR + "/dh_params.pem"
+
+DEFAULT_DH_KEY_SIZE = 2048
+
+# RFC 3526 MODP groups (generator 2), used when no parameters file has been generated
+RFC3526_PRIMES = {
+    2048: (
+        "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+        "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+        "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+        "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+        "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+        "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+        "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+        "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF"
+    ),
+    3072: (
+        "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+        "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+        "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+        "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+        "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+        "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+        "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+        "3995497CEA956AE515D2261898FA051015728E5A8AAAC42DAD33170D04507A33"
+        "A85521ABDF1CBA64ECFB850458DBEF0A8AEA71575D060C7DB3970F85A6E1E4C7"
+        "ABF5AE8CDB0933D71E8C94E04A25619DCEE3D2261AD2EE6BF12FFA06D98A0864"
+        "D87602733EC86A64521F2B18177B200CBBE117577A615D6C770988C0BAD946E2"
+        "08E24FA074E5AB3143DB5BFCE0FD108E4B82D120A93AD2CAFFFFFFFFFFFFFFFF"
+    ),
+    4096: (
+        "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+        "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+        "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+        "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+        "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+        "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+        "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+        "3995497CEA956AE515D2261898FA051015728E5A8AAAC42DAD33170D04507A33"
+        "A85521ABDF1CBA64ECFB850458DBEF0A8AEA71575D060C7DB3970F85A6E1E4C7"
+        "ABF5AE8CDB0933D71E8C94E04A25619DCEE3D2261AD2EE6BF12FFA06D98A0864"
+        "D87602733EC86A64521F2B18177B200CBBE117577A615D6C770988C0BAD946E2"
+        "08E24FA074E5AB3143DB5BFCE0FD108E4B82D120A92108011A723C12A787E6D7"
+        "88719A10BDBA5B2699C327186AF4E23C1A946834B6150BDA2583E9CA2AD44CE8"
+        "DBBBC2DB04DE8EF92E8EFC141FBECAA6287C59474E6BC05D99B2964FA090C3A2"
+        "233BA186515BE7ED1F612970CEE2D7AFB81BDD762170481CD0069127D5B05AA9"
+        "93B4EA988D8FDDC186FFB7DC90A6C08F4DF435C934063199FFFFFFFFFFFFFFFF"
+    ),
+}
+
+
+def build_conf_of_dh(app_conf: ConfigParser) -> dict:
+    return {
+        "key_size": app_conf.getint("dh", "key_size", fallback=DEFAULT_DH_KEY_SIZE),
+        "pool_size": app_conf.getint("dh", "pool_size", fallback=128),
+        "pool_low_watermark": app_conf.getint("dh", "pool_low_watermark", fallback=32),
+        "params_file": app_conf.get("dh", "params_file", fallback=DEFAULT_DH_PARAMS_FILE)
+    }
+
+
+def generate_dh_parameters_file(params_file: str, key_size: int) -> dh.DHParameters:
+    logging.info(f"Generating DH parameters with a key size of {key_size} bits, this may take a while...")
+    parameters = dh.generate_parameters(generator=2, key_size=key_size)
+
+    # Write-then-rename so concurrently starting workers never read a half-written file
+    tmp_file = f"{params_file}.{os.getpid()}.tmp"
+    with open(file=tmp_file, mode="wb") as params_f:
+        params_f.write(parameters.parameter_bytes(serialization.Encoding.PEM, serialization.ParameterFormat.PKCS3))
+    os.replace(tmp_file, params_file)
+
+    logging.info(f"DH parameters saved to {params_file}")
+    return parameters
+
+
+def load_dh_parameters(key_size: int, params_file: Optional[str] = None) -> dh.DHParameters:
+    if params_file and os.path.exists(params_file):
+        with open(file=params_file, mode="rb") as params_f:
+            parameters = serialization.load_pem_parameters(params_f.read())
+
+        if parameters.parameter_numbers().p.bit_length() != key_size:
+            logging.warning(
+                f"DH parameters file {params_file} holds a {parameters.parameter_numbers().p.bit_length()}-bit " + \
+                f"group, configured key size {key_size} is ignored")
+
+        logging.debug(f"DH parameters loaded from {params_file}")
+        return parameters
+
+    if key_size in RFC3526_PRIMES:
+        logging.debug(f"Using RFC 3526 {key_size}-bit MODP group for DH parameters")
+        return dh.DHParameterNumbers(p=int("".join(RFC3526_PRIMES[key_size]), 16), g=2).parameters()
+
+    if params_file:
+        return generate_dh_parameters_file(params_file=params_file, key_size=key_size)
+
+    return dh.generate_parameters(generator=2, key_size=key_size)
+
+
+def gen_dh_params_util(args):
+    from .config_parser import load_config, DEFAULT_CONFIG_FILE
+
+    dh_conf = build_conf_of_dh(load_config(file=args.config if args.config else DEFAULT_CONFIG_FILE))
+
+    if not os.path.exists(dh_conf["params_file"]):
+        generate_dh_parameters_file(params_file=dh_conf["params_file"], key_size=dh_conf["key_size"])
+        print("DH parameters file generated")
+
+    else:
+        print("error: DH parameters file already exists")
+
 
 class DHParameterCache:
-    def __init__(self, key_size: int = 512, pool_size: int = 128):
+    """Holds the DH group and a pool of fresh, single-use private keys.
+
+    A background producer tops the pool back up to ``pool_size`` whenever it drops to
+    ``low_watermark``, so handshakes only generate keys inline when the pool runs dry."""
+
+    def __init__(self, key_size: int = DEFAULT_DH_KEY_SIZE, pool_size: int = 128, params_file: Optional[str] = None,
+                 low_watermark: Optional[int] = None):
         self.key_size = key_size
         self.pool_size = pool_size
+        self.low_watermark = pool_size // 4 if low_watermark is None else min(low_watermark, pool_size)
+        self.params_file = params_file
         self._parameters: Optional[dh.DHParameters] = None
         self._private_keys_pool: Queue = Queue(maxsize=pool_size)
         self._lock = threading.Lock()
         self._initialized = False
 
+        self._refill_needed = threading.Event()
+        self._stopped = threading.Event()
+        self._refill_thread: Optional[threading.Thread] = None
+
+        self.keys_served = Counter("dh_keys_served")
+        self.pool_misses = Counter("dh_pool_misses")
+        self.keys_generated = Counter("dh_keys_generated")
+
         self._initialize()
     
     def _initialize(self):
@@ -31,19 +165,45 @@ class DHParameterCache:
             try:
                 logging.info(f"Initialization of DH parameters with a key size of {self.key_size} bits...")
 
-                self._parameters = dh.generate_parameters(generator=2, key_size=self.key_size)
+                self._parameters = load_dh_parameters(key_size=self.key_size, params_file=self.params_file)
 
-                logging.debug(f"Generating pool of {self.pool_size} private keys...")
-                for _ in range(self.pool_size):
-                    private_key = self._parameters.generate_private_key()
-                    self._private_keys_pool.put(private_key)
+                logging.debug(f"Starting private key producer (pool {self.pool_size}, " + \
+                              f"low watermark {self.low_watermark})...")
+                self._refill_thread = threading.Thread(target=self._refill_loop, name="dh-key-refill", daemon=True)
+                self._refill_thread.start()
+                self._refill_needed.set()
                 
                 self._initialized = True
-                logging.debug("DH parameters and key pool initialized successfully")
+                logging.debug("DH parameters initialized successfully")
                 
             except Exception as e:
                 logging.error(f"Error creating DH parameters: {e}")
                 raise
+
+    def _refill_loop(self):
+        while not self._stopped.is_set():
+            self._refill_needed.wait()
+            self._refill_needed.clear()
+
+            while not self._stopped.is_set() and not self._private_keys_pool.full():
+                try:
+                    self._private_keys_pool.put_nowait(self._parameters.generate_private_key())
+                    self.keys_generated.inc()
+                except Full:
+                    break
+                except Exception:
+                    logging.exception("DH private key producer failed to generate a key")
+                    self._stopped.wait(1.0)
+                    break
+
+            logging.debug(f"DH private key pool refilled ({self.stats()})")
+
+    @property
+    def pool_depth(self) -> int:
+        return self._private_keys_pool.qsize()
+
+    def stats(self) -> str:
+        return f"depth={self.pool_depth} {self.keys_served} {self.pool_misses} {self.keys_generated}"
     
     def get_parameters(self) -> dh.DHParameters:
         if not self._initialized:
@@ -53,27 +213,35 @@ class DHParameterCache:
     def get_private_key(self) -> dh.DHPrivateKey:
         if not self._initialized:
             self._initialize()
-            
+
+        self.keys_served.inc()
         try:
-            return self._private_keys_pool.get_nowait()
+            private_key = self._private_keys_pool.get_nowait()
         except Empty:
+            self.pool_misses.inc()
+            self._refill_needed.set()
             logging.warning("Private key pool is empty, generate new key")
             return self._parameters.generate_private_key()
-    
-    def return_private_key(self, private_key: dh.DHPrivateKey):
-        try:
-            self._private_keys_pool.put_nowait(private_key)
-        except:
-            pass
+
+        if self._private_keys_pool.qsize() <= self.low_watermark:
+            self._refill_needed.set()
+
+        return private_key
+
+    def stop(self):
+        self._stopped.set()
+        self._refill_needed.set()
     
     def get_parameter_numbers(self):
         return self.get_parameters().parameter_numbers()
 
 
 class OptimizedDHKeyExchange:
-    def __init__(self, key_size: int = 512, pool_size: int = 100):
-        self.cache = DHParameterCache(key_size, pool_size)
+    def __init__(self, key_size: int = DEFAULT_DH_KEY_SIZE, pool_size: int = 100, params_file: Optional[str] = None,
+                 pool_low_watermark: Optional[int] = None):
+        self.cache = DHParameterCache(key_size, pool_size, params_file, pool_low_watermark)
         self._hash_algorithm = hashes.BLAKE2b(64)
+        self._parameters_frame: Optional[bytes] = None
         
     def generate_session_key(self, shared_key: bytes) -> bytes:
         digest = hashes.Hash(self._hash_algorithm, backend=default_backend())
@@ -88,6 +256,22 @@ class OptimizedDHKeyExchange:
         g_bytes = pn.g.to_bytes((pn.g.bit_length() + 7) // 8, byteorder="big")
         
         return p_bytes, g_bytes
+
+    def get_parameters_frame(self) -> bytes:
+        """Length-prefixed p and g as sent to legacy clients; constant for the process, so built once."""
+        if self._parameters_frame is None:
+            p_bytes, g_bytes = self.get_parameters_for_client()
+            self._parameters_frame = struct.pack("!I", len(p_bytes)) + p_bytes + struct.pack("!I", len(g_bytes)) + g_bytes
+
+        return self._parameters_frame
+
+    def create_server_handshake(self) -> tuple[dh.DHPrivateKey, bytes]:
+        """Returns the server private key and the whole server side of the legacy handshake
+        (p, g and server public value, each length-prefixed) as one buffer for a single send."""
+        server_private_key, server_public_bytes = self.create_server_keypair()
+
+        return server_private_key, b"".join(
+            (self.get_parameters_frame(), struct.pack("!I", len(server_public_bytes)), server_public_bytes))
     
     def create_server_keypair(self) -> tuple[dh.DHPrivateKey, bytes]:
         private_key = self.cache.get_private_key()
@@ -105,19 +289,17 @@ class OptimizedDHKeyExchange:
         shared_key = server_private_key.exchange(client_public_key)
 
         return self.generate_session_key(shared_key)
-    
-    def cleanup_private_key(self, private_key: dh.DHPrivateKey):
-        self.cache.return_private_key(private_key)
 
 
 _global_dh_exchange: Optional[OptimizedDHKeyExchange] = None
 _global_lock = threading.Lock()
 
 
-def get_dh_exchange(key_size: int = 512, pool_size: int = 100) -> OptimizedDHKeyExchange:
+def get_dh_exchange(key_size: int = DEFAULT_DH_KEY_SIZE, pool_size: int = 100,
+                    params_file: Optional[str] = None, pool_low_watermark: Optional[int] = None) -> OptimizedDHKeyExchange:
     global _global_dh_exchange
     
     with _global_lock:
         if _global_dh_exchange is None:
-            _global_dh_exchange = OptimizedDHKeyExchange(key_size, pool_size)
+            _global_dh_exchange = OptimizedDHKeyExchange(key_size, pool_size, params_file, pool_low_watermark)
         return _global_dh_exchange
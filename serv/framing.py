@@ -0,0 +1,53 @@
+import struct
+
+
+# Protocol <= 15: u32 payload length | u32 trans code length | enc(trans code) | enc(payload)
+PACKAGE_HEADER = struct.Struct("!II")
+
+# Protocol >= 16: u32 frame length | enc(u16 opcode | payload)
+FRAME_HEADER = struct.Struct("!I")
+OPCODE = struct.Struct("!H")
+
+OPCODE_FRAMING_PROTOCOL_VERSION = 16
+
+RESPONSE_FLAG = 0x8000
+ERROR_OPCODE = 0xFFFF
+
+# Every registered transaction needs an opcode here, TransactionRegistry.register refuses one without
+TRANSACTION_OPCODES = {
+    "CONNECTION_TEST": 0x0001,
+
+    "REGISTER_ACCOUNT": 0x0010,
+    "GEN_VERIFY_TOKEN": 0x0011,
+    "CHECK_ACCOUNT_ACCESS_BY_PASSWORD": 0x0012,
+    "VERIFY_TOKEN": 0x0013,
+
+    "SEND_MSG": 0x0020,
+    "UPDATE_PDS": 0x0021,
+    "READ_ALL_MESSAGES": 0x0022,
+    "READ_MESSAGES_OF_CHAT": 0x0023
+}
+
+_OPCODE_TRANSACTIONS = {opcode: code for code, opcode in TRANSACTION_OPCODES.items()}
+
+
+def encode_transaction_code(transaction_code: str) -> int:
+    if transaction_code == "ERROR:RESPONSE":
+        return ERROR_OPCODE
+
+    if transaction_code.endswith(":RESPONSE"):
+        return TRANSACTION_OPCODES[transaction_code[:-len(":RESPONSE")]] | RESPONSE_FLAG
+
+    return TRANSACTION_OPCODES[transaction_code]
+
+
+def decode_opcode(opcode: int) -> str:
+    if opcode == ERROR_OPCODE:
+        return "ERROR:RESPONSE"
+
+    transaction_code = _OPCODE_TRANSACTIONS.get(opcode & ~RESPONSE_FLAG)
+    if transaction_code is None:
+        # Unknown opcodes still reach the request handler, which answers with invalid_transaction_code
+        return f"OPCODE_{opcode:#06x}"
+
+    return transaction_code + ":RESPONSE" if opcode & RESPONSE_FLAG else transaction_code
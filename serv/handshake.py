@@ -0,0 +1,85 @@
+import struct
+
+from configparser import ConfigParser
+from pathlib import Path
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+CRYPT_TCP_PROTOCOL_VERSION_FILE = str(Path(__file__).resolve().parent.parent) + "/data/vers/crypt_tcp_protocol_version"
+
+# Clients that never send a hello get the finite-field DH handshake of this protocol version
+LEGACY_PROTOCOL_VERSION = 14
+X25519_PROTOCOL_VERSION = 15
+
+HELLO_MAGIC = b"SWHS"
+HELLO_FORMAT = "!4sH32s"
+HELLO_SIZE = struct.calcsize(HELLO_FORMAT)
+
+# auto waits up to hello_timeout for a hello before falling back to DH, which delays every legacy client's
+# handshake by that much; legacy and x25519 serve a single client generation without the wait
+HANDSHAKE_MODES = ("auto", "legacy", "x25519")
+
+
+def load_tcp_protocol_version() -> int:
+    with open(file=CRYPT_TCP_PROTOCOL_VERSION_FILE, mode="r", encoding="UTF-8") as proto_vers_file_tcp:
+        return int(proto_vers_file_tcp.readline().strip())
+
+
+def build_conf_of_handshake(app_conf: ConfigParser) -> dict:
+    mode = app_conf.get("client_tcp_endpoint", "handshake", fallback="auto")
+    if mode not in HANDSHAKE_MODES:
+        raise ValueError(f"Unknown client_tcp_endpoint handshake '{mode}', " + \
+                         f"expected one of: {', '.join(HANDSHAKE_MODES)}")
+
+    return {
+        "mode": mode,
+        "hello_timeout": app_conf.getfloat("client_tcp_endpoint", "hello_timeout", fallback=0.25)
+    }
+
+
+class X25519Handshake:
+    """Client-initiated handshake (protocol >= 15).
+
+    Client sends ``HELLO_MAGIC | u16 protocol version | 32-byte X25519 public key``, server answers
+    ``u16 negotiated version | 32-byte X25519 public key``. Both sides derive the session key with
+    HKDF-SHA256 over the shared secret, salted with both public keys."""
+
+    def __init__(self, server_protocol_version: int):
+        self.server_protocol_version = server_protocol_version
+
+    @staticmethod
+    def parse_client_hello(hello: bytes) -> tuple[int, bytes]:
+        magic, client_version, client_public_bytes = struct.unpack(HELLO_FORMAT, hello)
+        if magic != HELLO_MAGIC:
+            raise ValueError("Invalid client hello magic")
+        if client_version < X25519_PROTOCOL_VERSION:
+            raise ValueError(f"Client hello with unsupported protocol version {client_version}")
+
+        return client_version, client_public_bytes
+
+    @staticmethod
+    def derive_session_key(shared_key: bytes, client_public_bytes: bytes, server_public_bytes: bytes,
+                           protocol_version: int) -> bytes:
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=client_public_bytes + server_public_bytes,
+            info=b"ShadowWire tcp_p" + str(protocol_version).encode()
+        ).derive(shared_key)
+
+    def respond(self, hello: bytes) -> tuple[bytes, bytes, int]:
+        """Returns (server reply, session key, negotiated protocol version) for a client hello."""
+        client_version, client_public_bytes = self.parse_client_hello(hello)
+        protocol_version = min(client_version, self.server_protocol_version)
+
+        server_private_key = X25519PrivateKey.generate()
+        server_public_bytes = server_private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+        shared_key = server_private_key.exchange(X25519PublicKey.from_public_bytes(client_public_bytes))
+        session_key = self.derive_session_key(shared_key, client_public_bytes, server_public_bytes, protocol_version)
+
+        return struct.pack("!H", protocol_version) + server_public_bytes, session_key, protocol_version
@@ -0,0 +1,47 @@
+import threading
+
+
+class Counter:
+    def __init__(self, name: str):
+        self.name = name
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def __str__(self):
+        return f"{self.name}={self._value}"
+
+
+class LatencyMetric:
+    def __init__(self, name: str):
+        self.name = name
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._count += 1
+            self._total += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "count": self._count,
+                "avg_ms": (self._total / self._count * 1000) if self._count else 0.0,
+                "max_ms": self._max * 1000
+            }
+
+    def __str__(self):
+        s = self.snapshot()
+        return f"{self.name}: count={s['count']} avg={s['avg_ms']:.3f}ms max={s['max_ms']:.3f}ms"
@@ -1,25 +1,47 @@
+import queue
+import selectors
 import socket
 import threading
 import logging
 import struct
+import time
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from configparser import ConfigParser
-from typing import List, Tuple, Callable
+from typing import Dict, Callable
 
-from .dh_optimizer import get_dh_exchange
-from libs.pycrypter import Crypter
+from .client_protocol import DH_PUBLIC_LENGTH, ClientProtocol
+from .dh_optimizer import get_dh_exchange, build_conf_of_dh
+from .handshake import HELLO_SIZE, X25519Handshake, build_conf_of_handshake, load_tcp_protocol_version
+from .metrics import LatencyMetric
+
+
+RECV_BUFFER_SIZE = 4096
+RECV_BUFFER_KEEP_SIZE = 65536
 
 
 class ClientConnection:
-    def __init__(self, client_socket, client_address, server_instance):
+    def __init__(self, client_socket, client_address, server_instance,
+                 on_finished: Callable[["ClientConnection"], None] | None = None):
         self.client_socket = client_socket
         self.client_address = client_address
         self.server_instance = server_instance
         self.request_handle_func = self.server_instance.request_handle_func
+        self.on_finished = on_finished
 
         self.running = True
-        self.crypter = None
-        self.dh_exchange = get_dh_exchange(key_size=512, pool_size=128)
+        self.protocol = ClientProtocol(self.server_instance, self.client_address)
+
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+
+        # Without pipelining the reader thread runs each request and sends its response itself. Pipelined
+        # responses are written by the connection's own writer thread, never by pool threads: a client that
+        # stops reading must only stall its own connection
+        self._pipelined = self.server_instance.max_in_flight > 1
+        self._send_queue: queue.Queue = queue.Queue()
+        self._writer_thread = None
+        self._in_flight = 0
+        self._in_flight_cond = threading.Condition()
 
     def _recv_exact(self, num_bytes: int) -> bytes:
         chunks = []
@@ -34,39 +56,63 @@ class ClientConnection:
 
         return b"".join(chunks)
 
-    def __init_session__(self):
-        try:
-            p_bytes, g_bytes = self.dh_exchange.get_parameters_for_client()
+    def _recv_client_hello(self) -> bytes | None:
+        """Waits for an X25519 client hello, None means the client expects the legacy DH handshake."""
+        if not self.protocol.expects_hello:
+            return None
 
-            self.client_socket.sendall(struct.pack("!I", len(p_bytes)) + p_bytes)
-            self.client_socket.sendall(struct.pack("!I", len(g_bytes)) + g_bytes)
+        if self.protocol.hello_timeout is not None:
+            # Legacy clients stay silent until they get the DH parameters, new ones speak first
+            self.client_socket.settimeout(self.protocol.hello_timeout)
+            try:
+                first_byte = self.client_socket.recv(1, socket.MSG_PEEK)
+            except socket.timeout:
+                return None
+            finally:
+                self.client_socket.settimeout(None)
 
-            server_private_key, server_public_bytes = self.dh_exchange.create_server_keypair()
+            if not first_byte:
+                raise ConnectionResetError("Client closed connection before handshake")
 
-            self.client_socket.sendall(struct.pack("!I", len(server_public_bytes)) + server_public_bytes)
+        hello = self._recv_exact(HELLO_SIZE)
+        if not hello or len(hello) != HELLO_SIZE:
+            raise ConnectionResetError("Client closed connection while sending hello")
 
-            client_public_length_bytes = self._recv_exact(4)
-            if not client_public_length_bytes:
-                raise ConnectionResetError("Client closed connection while sending public key length")
-            client_public_length = struct.unpack("!I", client_public_length_bytes)[0]
-            client_public_bytes = self._recv_exact(client_public_length)
-            if not client_public_bytes or len(client_public_bytes) != client_public_length:
-                raise ConnectionResetError("Client closed connection while sending public key bytes")
-            client_public_y = int.from_bytes(client_public_bytes, byteorder="big")
+        return hello
 
-            pn = self.dh_exchange.cache.get_parameter_numbers()
+    def _recv_into_buffer(self, num_bytes: int) -> memoryview | None:
+        """Reads exactly num_bytes into the connection's reusable buffer.
 
-            self.session_key = self.dh_exchange.derive_shared_key(
-                server_private_key, client_public_y, pn
-            )
+        The returned view is only valid until the next read, callers must be done with it by then."""
+        if len(self._recv_buffer) < num_bytes:
+            self._recv_buffer = bytearray(num_bytes)
+
+        view = memoryview(self._recv_buffer)[:num_bytes]
+        received = 0
+        while received < num_bytes:
+            chunk_size = self.client_socket.recv_into(view[received:], num_bytes - received)
+            if not chunk_size:
+                return None
+            received += chunk_size
 
-            self.crypter = Crypter(self.session_key)
+        return view
 
-            self.dh_exchange.cleanup_private_key(server_private_key)
+    def _shrink_recv_buffer(self):
+        # Don't let one large image pin megabytes on a connection that then goes idle
+        if len(self._recv_buffer) > RECV_BUFFER_KEEP_SIZE:
+            self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
 
-            logging.debug(
-                f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
-                f"Server session key for {self.client_address[0]}: {self.session_key.hex()}")
+    def __init_session__(self):
+        try:
+            hello = self._recv_client_hello()
+            if hello is None:
+                self.__init_dh_session__()
+            else:
+                self.client_socket.sendall(self.protocol.finish_x25519_handshake(hello))
+
+            self.protocol.start_session()
+            if self._pipelined:
+                self._start_writer()
 
         except ConnectionResetError:
             self.stop()
@@ -76,37 +122,53 @@ class ClientConnection:
                 f"Key exchange failed for client {self.client_address[0]}:")
             raise
 
+    def __init_dh_session__(self):
+        server_private_key, server_handshake = self.protocol.create_dh_handshake()
+
+        self.client_socket.sendall(server_handshake)
+
+        client_public_length_bytes = self._recv_exact(DH_PUBLIC_LENGTH.size)
+        if not client_public_length_bytes:
+            raise ConnectionResetError("Client closed connection while sending public key length")
+        client_public_length, = DH_PUBLIC_LENGTH.unpack(client_public_length_bytes)
+        client_public_bytes = self._recv_exact(client_public_length)
+        if not client_public_bytes or len(client_public_bytes) != client_public_length:
+            raise ConnectionResetError("Client closed connection while sending public key bytes")
+
+        self.protocol.finish_dh_handshake(server_private_key, client_public_bytes)
+
+    def _recv_package(self) -> tuple[bytes, str] | None:
+        header = self._recv_into_buffer(self.protocol.header_size)
+        if header is None:
+            return None
+
+        lengths = self.protocol.decode_header(header)
+        if lengths is None:
+            return None
+        body_length, trans_length = lengths
+
+        body = self._recv_into_buffer(body_length)
+        if body is None:
+            return None
+
+        return self.protocol.decode_body(body, trans_length)
+
     def handle(self):
         try:
             self.__init_session__()
 
             while self.running:
                 try:
-                    length_bytes = self._recv_exact(4)
-                    if not length_bytes:
-                        break
-                    pkg_length = struct.unpack("!I", length_bytes)[0]
-
-                    trans_length_bytes = self._recv_exact(4)
-                    if not trans_length_bytes:
-                        break
-                    trans_length = struct.unpack("!I", trans_length_bytes)[0]
-
-                    encrypted_trans_code = self._recv_exact(trans_length)
-                    if not encrypted_trans_code or len(encrypted_trans_code) != trans_length:
+                    received = self._recv_package()
+                    if received is None:
                         break
-
-                    encrypted_data = self._recv_exact(pkg_length)
-                    if not encrypted_data or len(encrypted_data) != pkg_length:
-                        break
-
-                    transaction_code = self.crypter.decrypt(encrypted_trans_code).decode("utf-8")
-                    data = self.crypter.decrypt(encrypted_data)
+                    data, transaction_code = received
 
                     logging.info(
                         f"{'[Server ' + self.server_instance.title_ + '] - ' if self.server_instance.title_ else ''}" + \
                         f"Client {self.client_address[0]} sent package of code '{transaction_code}'")
                     self.process_request(data, transaction_code)
+                    self._shrink_recv_buffer()
 
                 except socket.timeout:
                     continue
@@ -122,27 +184,120 @@ class ClientConnection:
         except Exception:
             logging.exception(f"Error in client handler for {self.client_address[0]}")
         finally:
+            self._wait_in_flight(timeout=5.0)
+            self._stop_writer()
             self.close_connection()
+            if self.on_finished:
+                self.on_finished(self)
 
     def process_request(self, data: bytes, transaction_code: str):
-        r_data, r_trans = self.request_handle_func(pkg=data, transaction_code=transaction_code)
-        self.send_pkg(pkg=r_data, transaction_code=r_trans)
+        """Without pipelining, processes the request and sends the response on the calling thread.
 
-    def send_pkg(self, pkg: bytes, transaction_code: str):
-        max_retries = 3
-        for attempt in range(max_retries):
-            trans_code_bytes = transaction_code.encode("utf-8")
-            encrypted_trans_code = self.crypter.encrypt(trans_code_bytes)
-            encrypted_pkg = self.crypter.encrypt(pkg)
-            pkg_data = (
-                    struct.pack("!I", len(encrypted_pkg)) +
-                    struct.pack("!I", len(encrypted_trans_code)) +
-                    encrypted_trans_code +
-                    encrypted_pkg
-            )
-            self.client_socket.sendall(pkg_data)
+        Otherwise hands the request to the server's worker pool and returns at once, so the next package
+        can be read while this one is processed. Blocks while the connection is at its in-flight limit."""
+        if not self._pipelined:
+            try:
+                result = self.request_handle_func(pkg=data, transaction_code=transaction_code,
+                                                  session=self.protocol.session)
+            except Exception:
+                logging.exception(f"Error processing request of client {self.client_address[0]}")
+                return
+
+            self._send_result(result)
+            return
+
+        with self._in_flight_cond:
+            while self._in_flight >= self.server_instance.max_in_flight and self.running:
+                self._in_flight_cond.wait()
+            if not self.running:
+                return
+            self._in_flight += 1
+
+        try:
+            future = self.server_instance.request_executor.submit(
+                self.request_handle_func, pkg=data, transaction_code=transaction_code, session=self.protocol.session)
+        except Exception:
+            self._request_finished()
+            raise
+
+        future.add_done_callback(self._on_request_done)
+
+    def _on_request_done(self, future: Future):
+        if future.cancelled():
+            self._request_finished()
+            return
+
+        try:
+            result = future.result()
+        except Exception:
+            logging.exception(f"Error processing request of client {self.client_address[0]}")
+            self._request_finished()
             return
 
+        # The request stays in flight until the writer has sent it, which keeps the per-connection
+        # limit as backpressure against a client that doesn't read its responses
+        self._send_queue.put(result)
+
+    def _start_writer(self):
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="conn-writer", daemon=True)
+        self._writer_thread.start()
+
+    def _writer_loop(self):
+        while True:
+            result = self._send_queue.get()
+            if result is None:
+                return
+
+            try:
+                self._send_result(result)
+            finally:
+                self._request_finished()
+
+    def _send_result(self, result):
+        try:
+            # Once the connection is stopped its socket is shut down, pending responses are dropped
+            if not self.running:
+                return
+
+            # A streamed response is an iterator of frames, produced page by page as they are sent
+            for r_data, r_trans in ((result,) if isinstance(result, tuple) else result):
+                self.send_pkg(pkg=r_data, transaction_code=r_trans)
+
+        except OSError:
+            # Also raised when the send timeout expires: the client stopped reading, drop it
+            if self.running:
+                logging.warning(f"Error sending response to client {self.client_address[0]}, disconnecting")
+            self.stop()
+
+        except Exception:
+            logging.exception(f"Error processing request of client {self.client_address[0]}")
+
+        finally:
+            if not isinstance(result, tuple) and hasattr(result, "close"):
+                result.close()
+
+    def _stop_writer(self):
+        if self._writer_thread is None:
+            return
+
+        self._send_queue.put(None)
+        self._writer_thread.join(timeout=5.0)
+        if self._writer_thread.is_alive():
+            self.stop()
+            self._writer_thread.join(timeout=5.0)
+
+    def _request_finished(self):
+        with self._in_flight_cond:
+            self._in_flight -= 1
+            self._in_flight_cond.notify_all()
+
+    def _wait_in_flight(self, timeout: float):
+        with self._in_flight_cond:
+            self._in_flight_cond.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def send_pkg(self, pkg: bytes, transaction_code: str):
+        self.client_socket.sendall(self.protocol.encode_package(pkg, transaction_code))
+
     def close_connection(self):
         try:
             self.client_socket.close()
@@ -157,6 +312,8 @@ class ClientConnection:
 
     def stop(self):
         self.running = False
+        with self._in_flight_cond:
+            self._in_flight_cond.notify_all()
         try:
             if hasattr(self, 'client_socket') and self.client_socket:
                 self.client_socket.shutdown(socket.SHUT_RDWR)
@@ -172,13 +329,40 @@ class TCPServer:
         self.title_ = title_
 
         self.handling = False
-        self.clients: List[Tuple[ClientConnection, threading.Thread]] = []
+        self.clients: Dict[ClientConnection, threading.Thread] = {}
+        self._clients_lock = threading.Lock()
+
+        self.dh_exchange = get_dh_exchange(**build_conf_of_dh(self.conf))
+
+        self.max_package_size = self.conf["client_tcp_endpoint"].getint("max_package_size", fallback=33554432)
+
+        self.max_in_flight = self.conf["client_tcp_endpoint"].getint("max_in_flight_per_connection", fallback=1)
+        self.send_timeout = self.conf["client_tcp_endpoint"].getfloat("send_timeout", fallback=30.0)
+        self.request_executor = ThreadPoolExecutor(
+            max_workers=self.conf["client_tcp_endpoint"].getint("request_workers", fallback=32),
+            thread_name_prefix="request")
+
+        self.protocol_version = load_tcp_protocol_version()
+        self.handshake_conf = build_conf_of_handshake(self.conf)
+        self.x25519_handshake = X25519Handshake(server_protocol_version=self.protocol_version)
+
+        self.accept_latency = LatencyMetric("accept_latency")
 
     def _bind_socket(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.conf["client_tcp_endpoint"].getint("workers", fallback=1) > 1:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind((self.conf["client_tcp_endpoint"]["host"], self.conf["client_tcp_endpoint"].getint("port")))
-        self.socket.settimeout(1.0)
+        self.socket.setblocking(False)
+
+        # stop() writes to the wakeup pair so the selector returns immediately instead of on a timeout
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ, data="accept")
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, data="wakeup")
 
         self.handling = True
 
@@ -200,44 +384,89 @@ class TCPServer:
             logging.exception(
                 f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}Error in main server loop:")
 
+        finally:
+            self._close_sockets()
+
     def main_loop(self):
-        self.clients = [(conn, th) for conn, th in self.clients if conn.running]
+        for key, _ in self._selector.select():
+            ready_at = time.perf_counter()
 
-        for conn, th in self.clients:
-            if not conn.running and th.is_alive():
-                th.join(timeout=1.0)
+            if key.data == "wakeup":
+                try:
+                    self._wakeup_r.recv(64)
+                except BlockingIOError:
+                    pass
+                continue
 
-        try:
-            client_socket, client_address = self.socket.accept()
+            self._accept_pending(ready_at)
+
+    def _accept_pending(self, ready_at: float):
+        while self.handling:
+            try:
+                client_socket, client_address = self.socket.accept()
+            except BlockingIOError:
+                return
+            except Exception:
+                if self.handling:
+                    logging.exception(
+                        f"Server '{self.title_ + '\' ' if self.title_ else ' '}- Error accepting client connection:")
+                return
+
+            client_socket.setblocking(True)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Send-only timeout (settimeout() would also cut idle reads): a client that stops
+            # reading fails the response's sendall and gets disconnected
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                     struct.pack("ll", int(self.send_timeout), int(self.send_timeout % 1 * 1e6)))
             logging.info(
                 f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}" + \
                 f"Connected client from {client_address[0]}")
-            c_handler = ClientConnection(client_socket, client_address, self)
+
+            c_handler = ClientConnection(client_socket, client_address, self, on_finished=self._reap_client)
             client_thread = threading.Thread(target=c_handler.handle)
+            with self._clients_lock:
+                self.clients[c_handler] = client_thread
             client_thread.start()
-            self.clients.append((c_handler, client_thread))
 
-        except socket.timeout:
-            pass
+            self.accept_latency.observe(time.perf_counter() - ready_at)
 
-        except Exception:
-            if self.handling:
-                logging.exception(
-                    f"Server '{self.title_ + '\' ' if self.title_ else ' '}- Error accepting client connection:")
+    def _reap_client(self, c_handler: ClientConnection):
+        with self._clients_lock:
+            self.clients.pop(c_handler, None)
+
+    def _close_sockets(self):
+        for sock_name in ("socket", "_wakeup_r", "_wakeup_w"):
+            sock = getattr(self, sock_name, None)
+            if sock is None:
+                continue
+            try:
+                sock.close()
+            except Exception:
+                logging.exception(f"Error closing server '{self.title_ + ' ' if self.title_ else ''} socket:")
+
+        if hasattr(self, "_selector"):
+            self._selector.close()
 
     def stop(self):
         logging.info(f"Stopping server '{self.title_ + '\' ' if self.title_ else ''}...")
         self.handling = False
 
-        for handler, thread in self.clients:
+        if hasattr(self, "_wakeup_w"):
+            try:
+                self._wakeup_w.send(b"\0")
+            except OSError:
+                pass
+
+        with self._clients_lock:
+            clients = list(self.clients.items())
+
+        for handler, thread in clients:
             handler.stop()
             if thread.is_alive():
                 thread.join(timeout=5.0)
 
-        if hasattr(self, "socket") and self.socket:
-            try:
-                self.socket.close()
-            except Exception:
-                logging.exception(f"Error closing server '{self.title_ + ' ' if self.title_ else ''} socket:")
+        self.request_executor.shutdown(wait=False, cancel_futures=True)
 
+        logging.debug(f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}{self.accept_latency}")
+        logging.debug(f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}DH key pool: {self.dh_exchange.cache.stats()}")
         logging.info(f"Server '{self.title_ + '\' ' if self.title_ else ''}shut down")
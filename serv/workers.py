@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+
+from configparser import ConfigParser
+from multiprocessing.connection import wait
+from typing import Callable, Dict
+
+
+class WorkerSupervisor:
+    """Prefork mode: runs N copies of a TCP server engine bound to the same port with SO_REUSEPORT
+    and restarts them if they die. Has the same constructor/main/stop surface as the engines."""
+
+    RESTART_DELAY = 1.0
+    STOP_TIMEOUT = 10.0
+
+    def __init__(self, conf: ConfigParser, request_handle_func: Callable, server_cls: type, title_: str | None = None):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Worker mode requires SO_REUSEPORT, which this platform does not support")
+
+        self.conf = conf
+        self.request_handle_func = request_handle_func
+        self.server_cls = server_cls
+
+        self.title_ = title_
+
+        self.workers_count = self.conf["client_tcp_endpoint"].getint("workers", fallback=1)
+
+        self.handling = False
+        self.workers: Dict[int, multiprocessing.Process] = {}
+        self._last_spawn: Dict[int, float] = {}
+
+        self._mp_context = multiprocessing.get_context("fork")
+
+    def _worker_main(self, index: int):
+        # The master owns the shutdown sequence, Ctrl-C in the terminal must not reach workers directly
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        server = self.server_cls(
+            conf=self.conf,
+            request_handle_func=self.request_handle_func,
+            title_=f"{self.title_ + '/' if self.title_ else ''}w{index}"
+        )
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: server.stop())
+
+        server.main()
+
+    def _spawn(self, index: int):
+        process = self._mp_context.Process(
+            target=self._worker_main,
+            args=(index,),
+            name=f"{self.title_ + '-' if self.title_ else ''}worker-{index}"
+        )
+        process.start()
+
+        self.workers[index] = process
+        self._last_spawn[index] = time.monotonic()
+
+        logging.info(
+            f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}" + \
+            f"Worker {index} started (pid {process.pid})")
+
+    def main(self):
+        self.handling = True
+
+        for index in range(self.workers_count):
+            self._spawn(index)
+
+        try:
+            while self.handling:
+                sentinels = {process.sentinel: index for index, process in self.workers.items()}
+                for sentinel in wait(list(sentinels), timeout=1.0):
+                    if not self.handling:
+                        break
+
+                    index = sentinels[sentinel]
+                    process = self.workers[index]
+                    process.join()
+
+                    logging.warning(
+                        f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}" + \
+                        f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting...")
+
+                    # Throttle crash loops instead of fork-bombing the box
+                    delay = self.RESTART_DELAY - (time.monotonic() - self._last_spawn[index])
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    if self.handling:
+                        self._spawn(index)
+
+        except Exception:
+            logging.exception(
+                f"{'[Server ' + self.title_ + '] - ' if self.title_ else ''}Error in worker supervisor loop:")
+
+    def stop(self):
+        logging.info(f"Stopping server '{self.title_ + '\' ' if self.title_ else ''}workers...")
+        self.handling = False
+
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for index, process in self.workers.items():
+            process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"Worker {index} (pid {process.pid}) did not stop in time, killing it")
+                process.kill()
+                process.join()
+
+        logging.info(f"Server '{self.title_ + '\' ' if self.title_ else ''}workers shut down")